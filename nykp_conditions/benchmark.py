@@ -0,0 +1,380 @@
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qs, quote, urlparse
+
+import pendulum
+import requests
+from requests.adapters import HTTPAdapter
+
+import utils.http_cache as http_cache
+import utils.slack as slack
+from utils.http import make_session, set_session
+from utils.scripts import try_main
+from utils.secrets import SLACK_BOT_TOKEN_ENV
+
+BENCHMARK_DIR = os.path.abspath(os.path.join(__file__, '../benchmark_data'))
+FIXTURES_DIR = os.path.join(BENCHMARK_DIR, 'fixtures')
+BASELINES_PATH = os.path.join(BENCHMARK_DIR, 'baselines.json')
+FIXTURE_INDEX_FILENAME = 'index.json'
+BENCHMARK_CHANNEL = 'benchmark'
+DEFAULT_REPEAT = 3
+DEFAULT_TIME_TOLERANCE = 0.25  # Fraction slower than baseline before it counts as a regression
+DEFAULT_MEMORY_TOLERANCE = 0.10
+
+# Dates in request URLs (2024-06-01, 20240601, 2024-06-01T00:00:00Z) are masked, so fixtures recorded on one day
+# still match the requests made on another
+_URL_DATE_PATTERN = re.compile(r'(?<![\d.])\d{4}-?\d{2}-?\d{2}(?:T\d{2}:\d{2}:\d{2}Z)?(?!\d)')
+
+
+def fixture_key(url: str) -> str:
+    # requests upper-cases percent escapes when it prepares a URL, so normalize those too
+    url = re.sub(r'%[0-9a-fA-F]{2}', lambda m: m.group(0).upper(), url)
+    return _URL_DATE_PATTERN.sub('{date}', url)
+
+
+class FixtureStore:
+    # Recorded response bodies on disk, looked up by date-masked URL
+
+    def __init__(self, path: str = FIXTURES_DIR):
+        self.path = path
+        self._lock = threading.Lock()
+        self.index: Dict[str, dict] = {}
+        self.meta: dict = {}
+        index_path = os.path.join(path, FIXTURE_INDEX_FILENAME)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                data = json.load(f)
+            self.index, self.meta = data['responses'], data['meta']
+
+    @property
+    def recorded_date(self) -> Optional[str]:
+        return self.meta.get('recorded_date')
+
+    def load(self, url: str) -> Optional[tuple]:
+        entry = self.index.get(fixture_key(url))
+        if entry is None:
+            return None
+        with open(os.path.join(self.path, entry['filename']), 'rb') as f:
+            return entry['content_type'], f.read()
+
+    def save(self, url: str, content_type: str, body: bytes):
+        key = fixture_key(url)
+        suffix = mimetypes.guess_extension(content_type.split(';')[0].strip()) or '.body'
+        filename = hashlib.sha1(key.encode()).hexdigest()[:16] + suffix
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, filename), 'wb') as f:
+                f.write(body)
+            self.index[key] = {'url': url, 'filename': filename, 'content_type': content_type}
+            self.meta['recorded_date'] = pendulum.today().format('YYYY-MM-DD')
+            with open(os.path.join(self.path, FIXTURE_INDEX_FILENAME), 'w') as f:
+                json.dump({'meta': self.meta, 'responses': self.index}, f, indent=1, sort_keys=True)
+
+
+class RecordingAdapter(HTTPAdapter):
+    def __init__(self, store: FixtureStore, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+
+    def send(self, request, **kwargs):
+        resp = super().send(request, **kwargs)
+        if resp.status_code == 200:
+            self.store.save(request.url, resp.headers.get('Content-Type', ''), resp.content)
+        return resp
+
+
+class ReplayAdapter(HTTPAdapter):
+    # Sends every request to the local stand-in server instead, with the original URL as a parameter. Going over a
+    # real socket keeps connection handling and response reading in what gets measured.
+
+    def __init__(self, server_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.server_url = server_url
+
+    def send(self, request, **kwargs):
+        request = request.copy()
+        request.url = f'{self.server_url}/replay?url={quote(request.url, safe="")}'
+        return super().send(request, **kwargs)
+
+
+def _session_with_adapter(adapter: HTTPAdapter) -> requests.Session:
+    session = make_session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class StandInServer:
+    # Serves recorded fixtures at /replay and acts as the Slack Web API at /slack/api/<method>
+
+    def __init__(self, store: FixtureStore):
+        self.store = store
+        self.slack_calls: List[str] = []
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, name='stand-in-server', daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _send(self, status: int, content_type: str, body: bytes):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                if parsed.path != '/replay':
+                    return self._send(404, 'text/plain', b'Unknown path')
+                url = parse_qs(parsed.query)['url'][0]
+                fixture = server.store.load(url)
+                if fixture is None:
+                    return self._send(404, 'text/plain', f'No fixture recorded for {url}'.encode())
+                self._send(200, *fixture)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                method = urlparse(self.path).path.rsplit('/', 1)[-1]
+                server.slack_calls.append(method)
+                resp = {'ok': True, 'channel': 'C0BENCHMARK', 'ts': f'{time.time():.6f}'}
+                if method == 'files.upload':
+                    resp['file'] = {'id': 'F0BENCHMARK'}
+                self._send(200, 'application/json', json.dumps(resp).encode())
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self) -> 'StandInServer':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+"""----------------------------------------------------------------------------
+Stages
+----------------------------------------------------------------------------"""
+
+
+def _bench_currents(date: str, tmp_dir: str):
+    from noaa_currents import default_nykp_station, format_currents_table, retrieve_currents_table
+    predictions = retrieve_currents_table(default_nykp_station.id, date=date)
+    format_currents_table(predictions.table, date=date)
+
+
+def _bench_advisories(date: str, tmp_dir: str):
+    from notify_nyc import get_waterbody_advisories
+    get_waterbody_advisories()
+
+
+def _bench_forecast(date: str, tmp_dir: str):
+    from nws_forecast import get_forecast_text, save_forecast_plot
+    get_forecast_text()
+    save_forecast_plot(path=os.path.join(tmp_dir, 'forecast.png'))
+
+
+def _bench_water_temps(date: str, tmp_dir: str):
+    from water_temps import get_water_temps, plot_temps_file
+    station, water_temps = get_water_temps()
+    plot_temps_file(water_temps, station)
+
+
+def _bench_post_conditions(date: str, tmp_dir: str):
+    import post_conditions
+    # Every run posts everything, rather than skipping what an earlier run already posted
+    post_conditions.main(post_conditions.parse_args().parse_args(['--channel', BENCHMARK_CHANNEL, '--dedup', 'false']))
+
+
+STAGES: Dict[str, Callable[[str, str], None]] = {
+    'currents': _bench_currents,
+    'advisories': _bench_advisories,
+    'forecast': _bench_forecast,
+    'water-temps': _bench_water_temps,
+    'post-conditions': _bench_post_conditions,
+}
+
+
+@dataclass
+class StageResult:
+    seconds: float  # Best of the timed runs
+    peak_mb: float  # Peak traced Python allocations during one separate run
+
+
+def _run_cold(stage: Callable[[str, str], None], date: str) -> None:
+    # Each run starts from an empty HTTP cache, like the first report of the day
+    tmp_dir = tempfile.mkdtemp(prefix='nykp-benchmark-')
+    previous_cache = http_cache.default_cache
+    http_cache.default_cache = http_cache.HttpCache(os.path.join(tmp_dir, 'http'))
+    try:
+        stage(date, tmp_dir)
+    finally:
+        http_cache.default_cache = previous_cache
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def measure_stage(stage: Callable[[str, str], None], date: str, repeat: int = DEFAULT_REPEAT) -> StageResult:
+    # Timing and memory tracing are separate runs, since tracemalloc slows everything it traces. One untimed run
+    # goes first, so first-time imports and setup aren't counted against whichever stage happens to trigger them.
+    _run_cold(stage, date)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _run_cold(stage, date)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        _run_cold(stage, date)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return StageResult(seconds=min(times), peak_mb=peak / 2 ** 20)
+
+
+@contextmanager
+def _slack_stand_in(api_url: str):
+    # Points Slack clients at the stand-in with no pacing, and puts the environment, the pacing and the cached
+    # clients back afterwards, so nothing later in the process posts to the stand-in or to the real Slack unpaced
+    saved_env = {name: os.environ.get(name) for name in (slack.SLACK_API_URL_ENV, SLACK_BOT_TOKEN_ENV)}
+    saved_interval = slack.SECONDS_PER_CHANNEL_POST
+    os.environ[slack.SLACK_API_URL_ENV] = api_url
+    os.environ.setdefault(SLACK_BOT_TOKEN_ENV, 'xoxb-benchmark')
+    slack.SECONDS_PER_CHANNEL_POST = 0.0
+    slack._cached_client.cache_clear()
+    slack._cached_token.cache_clear()
+    try:
+        yield
+    finally:
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        slack.SECONDS_PER_CHANNEL_POST = saved_interval
+        slack._cached_client.cache_clear()
+        slack._cached_token.cache_clear()
+
+
+def run_benchmarks(
+        names: List[str], record: bool = False, repeat: int = DEFAULT_REPEAT, fixtures_dir: str = FIXTURES_DIR,
+) -> Dict[str, StageResult]:
+    store = FixtureStore(fixtures_dir)
+    if not record and not store.index:
+        raise FileNotFoundError(f'No fixtures in {fixtures_dir}; run with --record first')
+    # Slack always goes to the stand-in, even while recording, and it has no rate limit to pace for
+    with StandInServer(store) as server, _slack_stand_in(f'{server.url}/slack/api/'):
+        if record:
+            previous = set_session(_session_with_adapter(RecordingAdapter(store)))
+            date = pendulum.today().format('YYYY-MM-DD')
+        else:
+            previous = set_session(_session_with_adapter(ReplayAdapter(server.url)))
+            date = store.recorded_date
+        try:
+            if record:
+                # One live pass to capture responses; the timings below are then against the stand-in
+                for name in names:
+                    _run_cold(STAGES[name], date)
+                set_session(_session_with_adapter(ReplayAdapter(server.url)))
+            return {name: measure_stage(STAGES[name], date, repeat=repeat) for name in names}
+        finally:
+            set_session(previous)
+
+
+def load_baselines(path: str = BASELINES_PATH) -> Dict[str, StageResult]:
+    try:
+        with open(path) as f:
+            return {name: StageResult(**result) for name, result in json.load(f).items()}
+    except FileNotFoundError:
+        return {}
+
+
+def save_baselines(results: Dict[str, StageResult], path: str = BASELINES_PATH):
+    baselines = load_baselines(path)
+    baselines.update(results)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({name: asdict(result) for name, result in baselines.items()}, f, indent=2, sort_keys=True)
+
+
+def find_regressions(
+        results: Dict[str, StageResult], baselines: Dict[str, StageResult],
+        time_tolerance: float = DEFAULT_TIME_TOLERANCE, memory_tolerance: float = DEFAULT_MEMORY_TOLERANCE,
+) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            continue
+        if result.seconds > baseline.seconds * (1 + time_tolerance):
+            regressions.append(f'{name}: {result.seconds:.3f} s vs. baseline {baseline.seconds:.3f} s')
+        if result.peak_mb > baseline.peak_mb * (1 + memory_tolerance):
+            regressions.append(f'{name}: {result.peak_mb:.1f} MB peak vs. baseline {baseline.peak_mb:.1f} MB')
+    return regressions
+
+
+"""----------------------------------------------------------------------------
+SCRIPT CODE
+----------------------------------------------------------------------------"""
+
+
+def parse_args():
+    parser = ArgumentParser(description='Time each fetch -> parse -> render -> post path against recorded responses')
+    parser.add_argument('stages', nargs='*', help=f"Any of: {', '.join(STAGES)} (default: all)")
+    parser.add_argument('--record', action='store_true',
+                        help='Fetch live responses into the fixtures first (Slack still goes to the stand-in)')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--update-baselines', action='store_true')
+    parser.add_argument('--time-tolerance', type=float, default=DEFAULT_TIME_TOLERANCE)
+    parser.add_argument('--memory-tolerance', type=float, default=DEFAULT_MEMORY_TOLERANCE)
+    return parser
+
+
+def main(args):
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+    names = args.stages or list(STAGES)
+    results = run_benchmarks(names, record=args.record, repeat=args.repeat)
+    baselines = load_baselines()
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        vs = f'  (baseline {baseline.seconds:.3f} s, {baseline.peak_mb:.1f} MB)' if baseline else ''
+        print(f'{name:<16} {result.seconds:8.3f} s {result.peak_mb:8.1f} MB{vs}')
+    if args.update_baselines:
+        save_baselines(results)
+        return
+    regressions = find_regressions(results, baselines, args.time_tolerance, args.memory_tolerance)
+    if regressions:
+        print('Regressions:\n' + '\n'.join(f'  {r}' for r in regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = parse_args()
+    try_main(main, parser)
@@ -0,0 +1,231 @@
+import os
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import pendulum
+
+from noaa_currents import (CURRENTS_CSV_DATE_FMT, CURRENTS_TIMEZONE, ParsedPredictions, Station, as_local_date,
+                           default_nykp_station, localize_wall_times, retrieve_currents_tables)
+from utils.archive import ARCHIVE_DIR, TIME_FIELD, MemmapArchive
+from utils.scripts import try_main
+from utils.units import MPH_PER_KNOT
+
+# 13 bytes per event, vs. a few hundred for a row of the raw table's strings
+CURRENTS_ARCHIVE_DTYPE = np.dtype([('t', 'datetime64[s]'), ('knots', 'float32'), ('event', 'u1')])  # t in UTC
+# First record of each local day; t is local midnight, stored naive
+DAY_INDEX_DTYPE = np.dtype([('t', 'datetime64[s]'), ('offset', 'int64')])
+EVENTS = ('slack', 'flood', 'ebb')
+UNKNOWN_EVENT = 255
+DEFAULT_DAYS_AHEAD = 365
+
+
+def encode_events(stages) -> np.ndarray:
+    stage = pd.Series(stages, dtype=str).str.lower()
+    is_slack = stage.str.contains('slack').to_numpy()
+    is_flood = stage.str.contains('flood').to_numpy() & ~is_slack
+    is_ebb = stage.str.contains('ebb').to_numpy() & ~is_slack
+    codes = np.select([is_slack, is_flood, is_ebb], [0, 1, 2], default=UNKNOWN_EVENT)
+    return codes.astype('u1')
+
+
+def _local_to_utc(index: pd.DatetimeIndex, tz: str) -> np.ndarray:
+    # Naive local times, in the order they happen, -> UTC datetime64[s]
+    return localize_wall_times(index, tz).tz_convert('UTC').tz_localize(None).to_numpy(dtype='datetime64[s]')
+
+
+@dataclass
+class CompactPredictions:
+    # The same events as ParsedPredictions in a fraction of the memory: one typed array per column
+    t: np.ndarray  # datetime64[s], UTC
+    knots: np.ndarray  # float32, flood positive as NOAA gives it; NaN at slack
+    event: np.ndarray  # uint8 index into EVENTS, or UNKNOWN_EVENT
+    tz: str = CURRENTS_TIMEZONE
+
+    @classmethod
+    def from_records(cls, records: np.ndarray, tz: str = CURRENTS_TIMEZONE) -> 'CompactPredictions':
+        return cls(records['t'], records['knots'], records['event'], tz=tz)
+
+    @classmethod
+    def from_table(cls, table: pd.DataFrame, tz: str = CURRENTS_TIMEZONE) -> 'CompactPredictions':
+        # From a raw predictions table, e.g. CurrentsPredictions.table. ParsedPredictions keeps the events in the order
+        # they happen, which is what tells the two times in the hour repeated at the end of DST apart.
+        events = ParsedPredictions.from_table(table).events
+        return cls(_local_to_utc(events.index, tz), events['knots'].to_numpy(dtype='float32'),
+                   encode_events(events['stage']), tz=tz)
+
+    def __len__(self) -> int:
+        return len(self.t)
+
+    @property
+    def nbytes(self) -> int:
+        return self.t.nbytes + self.knots.nbytes + self.event.nbytes
+
+    def to_records(self) -> np.ndarray:
+        records = np.empty(len(self), dtype=CURRENTS_ARCHIVE_DTYPE)
+        records['t'], records['knots'], records['event'] = self.t, self.knots, self.event
+        return records
+
+    @property
+    def local_times(self) -> pd.DatetimeIndex:
+        return pd.DatetimeIndex(self.t).tz_localize('UTC').tz_convert(self.tz).tz_localize(None)
+
+    @property
+    def events(self) -> pd.DataFrame:
+        # In the shape of ParsedPredictions.events, so it can be formatted or fed to CurrentsIndex
+        codes = np.where(self.event == UNKNOWN_EVENT, -1, self.event).astype('int8')
+        knots = np.asarray(self.knots, dtype='float64')
+        return pd.DataFrame(
+            {'stage': pd.Categorical.from_codes(codes, categories=list(EVENTS)), 'knots': knots,
+             'mph': knots * MPH_PER_KNOT},
+            index=self.local_times.rename('datetime'),
+        )
+
+    @property
+    def parsed(self) -> ParsedPredictions:
+        return ParsedPredictions(self.events)
+
+
+def _as_day(d) -> np.datetime64:
+    return np.datetime64(as_local_date(d).format(CURRENTS_CSV_DATE_FMT), 's')
+
+
+class CurrentsArchive:
+    # One station's predictions, append-only and memory-mapped, with a day index alongside. A day is found by
+    # binary searching the small index, and only that day's records are read from the events file.
+
+    def __init__(self, station_id: str, directory: str = ARCHIVE_DIR, tz: str = CURRENTS_TIMEZONE):
+        self.station_id = station_id
+        self.tz = tz
+        self.event_file = MemmapArchive(os.path.join(directory, f'currents_{station_id}.bin'), CURRENTS_ARCHIVE_DTYPE)
+        self.day_index = MemmapArchive(os.path.join(directory, f'currents_{station_id}_days.bin'), DAY_INDEX_DTYPE)
+
+    @property
+    def last_day(self) -> Optional[pendulum.DateTime]:
+        self._reconcile()
+        last = self.day_index.last_time
+        if last is None:
+            return None
+        return pendulum.parse(str(last.astype('datetime64[D]')), tz=self.tz)
+
+    def _reconcile(self):
+        # Indexes the days at the end of the events file that have no index entry yet. append writes the events,
+        # then the index, so this covers both a normal append and a process that died between the two.
+        days = self.day_index.records()
+        indexed = int(days['offset'][-1]) if len(days) else 0
+        tail = self.event_file.records()[indexed:]
+        if len(tail) == 0:
+            return
+        local_days = CompactPredictions.from_records(tail, tz=self.tz).local_times.normalize()
+        local_days = local_days.to_numpy(dtype='datetime64[s]')
+        offsets = indexed + np.arange(len(tail))
+        if len(days):
+            newer = local_days > days[TIME_FIELD][-1]
+            local_days, offsets = local_days[newer], offsets[newer]
+        if len(local_days) == 0:
+            return
+        day_starts = np.flatnonzero(np.concatenate([[True], local_days[1:] != local_days[:-1]]))
+        index = np.empty(len(day_starts), dtype=DAY_INDEX_DTYPE)
+        index['t'] = local_days[day_starts]
+        index['offset'] = offsets[day_starts]
+        self.day_index.append(index)
+
+    def append(self, predictions: CompactPredictions) -> int:
+        # Whole local days after the last one stored; anything earlier is already there
+        self._reconcile()
+        records = predictions.to_records()
+        local_days = predictions.local_times.normalize().to_numpy(dtype='datetime64[s]')
+        last_day = self.day_index.last_time
+        if last_day is not None:
+            records = records[local_days > last_day]
+        if len(records) == 0:
+            return 0
+        # The event file sorts and drops anything at or before what another writer stored first; the index then
+        # comes from what was actually written
+        appended = self.event_file.append(records)
+        if appended:
+            self._reconcile()
+        return appended
+
+    def _offsets(self, first_day: np.datetime64, last_day: np.datetime64) -> (int, int):
+        days = self.day_index.records()
+        lo = np.searchsorted(days[TIME_FIELD], first_day, side='left')
+        hi = np.searchsorted(days[TIME_FIELD], last_day, side='right')
+        start = int(days['offset'][lo]) if lo < len(days) else len(self.event_file)
+        end = int(days['offset'][hi]) if hi < len(days) else len(self.event_file)
+        return start, end
+
+    def read(self, start=None, end=None) -> CompactPredictions:
+        # Every event on local days start..end, inclusive
+        self._reconcile()
+        days = self.day_index.records()
+        if len(days) == 0:
+            return CompactPredictions.from_records(np.empty(0, dtype=CURRENTS_ARCHIVE_DTYPE), tz=self.tz)
+        first = days[TIME_FIELD][0] if start is None else _as_day(start)
+        last = days[TIME_FIELD][-1] if end is None else _as_day(end)
+        lo, hi = self._offsets(first, last)
+        records = self.event_file.records()[lo:hi] if hi > lo else np.empty(0, dtype=CURRENTS_ARCHIVE_DTYPE)
+        return CompactPredictions.from_records(records, tz=self.tz)
+
+    def day(self, date) -> CompactPredictions:
+        return self.read(date, date)
+
+
+def update_currents_archives(
+        stations: Sequence[Station],
+        through=None,
+        start=None,
+        directory: str = ARCHIVE_DIR,
+) -> Dict[str, int]:
+    # Extends each station's archive through `through` (default: a year from today). Stations are grouped by the
+    # day their archive picks up from, so they share requests whenever they're in step.
+    start = as_local_date(start)
+    through = start.add(days=DEFAULT_DAYS_AHEAD) if through is None else as_local_date(through)
+    archives = {station.id: CurrentsArchive(station.id, directory=directory) for station in stations}
+    by_start: Dict[pendulum.DateTime, list] = {}
+    for station in stations:
+        last_day = archives[station.id].last_day
+        fetch_from = start if last_day is None else max(start, last_day.add(days=1))
+        if fetch_from <= through:
+            by_start.setdefault(fetch_from, []).append(station)
+
+    appended = {station.id: 0 for station in stations}
+    for fetch_from, group in by_start.items():
+        tables = retrieve_currents_tables(group, start=fetch_from, end=through)
+        for station_id, table in tables.groupby(level='station', sort=False):
+            compact = CompactPredictions.from_table(table.reset_index(drop=True))
+            appended[station_id] += archives[station_id].append(compact)
+    return appended
+
+
+"""----------------------------------------------------------------------------
+SCRIPT CODE
+----------------------------------------------------------------------------"""
+
+
+def parse_args():
+    parser = ArgumentParser(description='Keep a compact local archive of current predictions')
+    parser.add_argument('--station', action='append', default=None, help='Station ID (repeatable)')
+    parser.add_argument('--through', type=str, default=None,
+                        help=f'Archive through this date (default: {DEFAULT_DAYS_AHEAD} days from today)')
+    parser.add_argument('--show', type=str, default=None, help='Print the archived table for this date')
+    return parser
+
+
+def main(args):
+    station_ids = args.station or [default_nykp_station.id]
+    stations = [Station(station_id, station_id) for station_id in station_ids]
+    if args.show is None:
+        for station_id, n in update_currents_archives(stations, through=args.through).items():
+            print(f'{station_id}: {n} new events')
+        return
+    day = as_local_date(args.show).format(CURRENTS_CSV_DATE_FMT)
+    for station_id in station_ids:
+        print(f'{station_id}\n{CurrentsArchive(station_id).day(day).parsed.format_days([day]).get(day, "")}')
+
+
+if __name__ == '__main__':
+    parser = parse_args()
+    try_main(main, parser)
@@ -0,0 +1,317 @@
+import json
+import os
+from argparse import ArgumentParser
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import pendulum
+
+from noaa_currents import (CSV_DATETIME_FMT, CurrentsPredictions, DATETIME_COL, EVENT_COL, SPEED_COL,
+                           default_nykp_station, station_link)
+from utils.http_cache import cached_read
+from utils.scripts import try_main
+
+HARMONICS_URL_TEMPLATE = ('https://api.tidesandcurrents.noaa.gov/mdapi/prod/webapi/stations/{id}/harcon.json'
+                          '?units=english{bin}')
+HARMONICS_DIR = os.path.abspath(os.path.join(__file__, '../../harmonics'))
+LOCAL_TIMEZONE = 'America/New_York'
+J2000 = np.datetime64('2000-01-01T12:00:00', 's')
+SECONDS_PER_DAY = 86400.0
+DEFAULT_STEP_MINUTES = 6
+
+# Equilibrium argument V as coefficients of (T, s, h, p, p1) plus a constant, in degrees (Schureman, 1958).
+# T is the hour angle of the mean sun, s/h/p/p1 the mean longitudes of the moon, sun, lunar perigee and perihelion.
+V_COEFFICIENTS = {
+    'M2': (2, -2, 2, 0, 0, 0),
+    'S2': (2, 0, 0, 0, 0, 0),
+    'N2': (2, -3, 2, 1, 0, 0),
+    'K2': (2, 0, 2, 0, 0, 0),
+    'K1': (1, 0, 1, 0, 0, -90),
+    'O1': (1, -2, 1, 0, 0, 90),
+    'P1': (1, 0, -1, 0, 0, 90),
+    'Q1': (1, -3, 1, 1, 0, 90),
+    '2Q1': (1, -4, 1, 2, 0, 90),
+    'RHO1': (1, -3, 3, -1, 0, 90),
+    'J1': (1, 1, 1, -1, 0, -90),
+    'OO1': (1, 2, 1, 0, 0, -90),
+    '2N2': (2, -4, 2, 2, 0, 0),
+    'NU2': (2, -3, 4, -1, 0, 0),
+    'MU2': (2, -4, 4, 0, 0, 0),
+    'L2': (2, -1, 2, -1, 0, 180),
+    'LAM2': (2, -1, 0, 1, 0, 180),
+    'T2': (2, 0, -1, 0, 1, 0),
+    'M4': (4, -4, 4, 0, 0, 0),
+    'MS4': (4, -2, 2, 0, 0, 0),
+    'MN4': (4, -5, 4, 1, 0, 0),
+    'M6': (6, -6, 6, 0, 0, 0),
+    'M8': (8, -8, 8, 0, 0, 0),
+    'S4': (4, 0, 0, 0, 0, 0),
+    'S6': (6, 0, 0, 0, 0, 0),
+    'MK3': (3, -2, 3, 0, 0, -90),
+    '2MK3': (3, -4, 3, 0, 0, 90),
+    'MM': (0, 1, 0, -1, 0, 0),
+    'MF': (0, 2, 0, 0, 0, 0),
+    'MSF': (0, 2, -2, 0, 0, 0),
+    'SA': (0, 0, 1, 0, 0, 0),
+    'SSA': (0, 0, 2, 0, 0, 0),
+}
+CONSTITUENTS = list(V_COEFFICIENTS)
+
+
+@dataclass
+class CurrentHarmonics:
+    station_id: str
+    # Major-axis amplitude (knots) and Greenwich phase lag (degrees) by constituent name
+    amplitudes: Dict[str, float]
+    phases: Dict[str, float]
+    mean: float = 0.0
+    azimuth: Optional[float] = None
+    flood_direction: Optional[float] = None
+    ignored: List[str] = field(default_factory=list)
+
+    @property
+    def flood_sign(self) -> int:
+        # Positive major-axis velocity is flood unless the axis points against the flood direction
+        if self.azimuth is None or self.flood_direction is None:
+            return 1
+        return 1 if np.cos(np.radians(self.azimuth - self.flood_direction)) >= 0 else -1
+
+    @classmethod
+    def from_noaa_json(
+            cls, station_id: str, data: dict, flood_direction: Optional[float] = None
+    ) -> 'CurrentHarmonics':
+        amplitudes, phases, ignored = {}, {}, []
+        azimuth, mean = None, 0.0
+        for row in data['HarmonicConstituents']:
+            name = (row.get('constName') or row.get('name')).upper()
+            amplitude = float(row.get('majorAmplitude', row.get('amplitude', 0.0)))
+            phase = float(row.get('majorPhaseGMT', row.get('phase_GMT', 0.0)))
+            azimuth = row.get('azi', azimuth)
+            mean = float(row.get('majorMeanSpeed', mean) or 0.0)
+            if name not in V_COEFFICIENTS:
+                if amplitude:
+                    ignored.append(name)
+                continue
+            amplitudes[name] = amplitude
+            phases[name] = phase
+        azimuth = None if azimuth is None else float(azimuth)
+        return cls(station_id, amplitudes, phases, mean=mean, azimuth=azimuth, flood_direction=flood_direction,
+                   ignored=ignored)
+
+
+def _split_bin(station_id: str) -> Tuple[str, Optional[str]]:
+    # Current station ids like NYH1927_13 carry the depth bin after the underscore
+    if '_' in station_id:
+        base, bin_nbr = station_id.rsplit('_', 1)
+        return base, bin_nbr
+    return station_id, None
+
+
+def load_harmonics(station_id: str, path: Optional[str] = None, flood_direction: Optional[float] = None
+                   ) -> CurrentHarmonics:
+    if path is None:
+        path = os.path.join(HARMONICS_DIR, f'{station_id}.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            data = json.load(f)
+    else:
+        base, bin_nbr = _split_bin(station_id)
+        url = HARMONICS_URL_TEMPLATE.format(id=base, bin='' if bin_nbr is None else f'&bin={bin_nbr}')
+        data = json.loads(cached_read(url, source='noaa_harmonics'))
+    return CurrentHarmonics.from_noaa_json(station_id, data, flood_direction=flood_direction)
+
+
+def _astronomical_arguments(times: np.ndarray) -> Dict[str, np.ndarray]:
+    # Mean longitudes in degrees, from days since J2000
+    d = (times.astype('datetime64[s]') - J2000).astype('float64') / SECONDS_PER_DAY
+    return {
+        'T': 360.0 * d,
+        's': 218.3164 + 13.17639648 * d,
+        'h': 280.4661 + 0.98564736 * d,
+        'p': 83.3535 + 0.11140353 * d,
+        'N': 125.0445 - 0.05295377 * d,
+        'p1': 282.9384 + 0.0000471 * d,
+    }
+
+
+def _node_corrections(n_deg: np.ndarray) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    # Node factor f and correction u (degrees) per constituent, as functions of the lunar node longitude
+    n = np.radians(n_deg)
+    cos_n, cos_2n, cos_3n = np.cos(n), np.cos(2 * n), np.cos(3 * n)
+    sin_n, sin_2n, sin_3n = np.sin(n), np.sin(2 * n), np.sin(3 * n)
+    one, zero = np.ones_like(n), np.zeros_like(n)
+
+    m2 = (1.0004 - 0.0373 * cos_n + 0.0002 * cos_2n, -2.14 * sin_n)
+    k1 = (1.0060 + 0.1150 * cos_n - 0.0088 * cos_2n + 0.0006 * cos_3n,
+          -8.86 * sin_n + 0.68 * sin_2n - 0.07 * sin_3n)
+    o1 = (1.0089 + 0.1871 * cos_n - 0.0147 * cos_2n + 0.0014 * cos_3n,
+          10.80 * sin_n - 1.34 * sin_2n + 0.19 * sin_3n)
+    k2 = (1.0241 + 0.2863 * cos_n + 0.0083 * cos_2n - 0.0015 * cos_3n,
+          -17.74 * sin_n + 0.68 * sin_2n - 0.04 * sin_3n)
+    j1 = (1.1029 + 0.1676 * cos_n - 0.0170 * cos_2n + 0.0016 * cos_3n,
+          -12.94 * sin_n + 1.34 * sin_2n - 0.19 * sin_3n)
+    oo1 = (1.1027 + 0.6504 * cos_n + 0.0317 * cos_2n - 0.0014 * cos_3n,
+           -36.68 * sin_n + 4.02 * sin_2n - 0.57 * sin_3n)
+    mm = (1.0000 - 0.1300 * cos_n + 0.0013 * cos_2n, zero)
+    mf = (1.0429 + 0.4135 * cos_n - 0.0040 * cos_2n, -23.74 * sin_n + 2.68 * sin_2n - 0.38 * sin_3n)
+    unity = (one, zero)
+
+    return {
+        'M2': m2, 'N2': m2, '2N2': m2, 'NU2': m2, 'MU2': m2, 'L2': m2, 'LAM2': m2,
+        'S2': unity, 'P1': unity, 'T2': unity, 'S4': unity, 'S6': unity, 'SA': unity, 'SSA': unity,
+        'K1': k1, 'O1': o1, 'Q1': o1, '2Q1': o1, 'RHO1': o1, 'K2': k2, 'J1': j1, 'OO1': oo1,
+        'MM': mm, 'MF': mf, 'MSF': (m2[0], -m2[1]),
+        'M4': (m2[0] ** 2, 2 * m2[1]), 'MS4': m2, 'MN4': (m2[0] ** 2, 2 * m2[1]),
+        'M6': (m2[0] ** 3, 3 * m2[1]), 'M8': (m2[0] ** 4, 4 * m2[1]),
+        'MK3': (m2[0] * k1[0], m2[1] + k1[1]), '2MK3': (m2[0] ** 2 * k1[0], 2 * m2[1] - k1[1]),
+    }
+
+
+def predict_velocities(harmonics: Sequence[CurrentHarmonics], times: np.ndarray) -> np.ndarray:
+    # Signed velocities (knots, flood positive) with shape (stations, times).
+    # Sum_c A_sc f_ct cos(V_ct + u_ct - G_sc) is Re[(A e^-iG) @ (f e^i(V+u))], so every station is one matmul.
+    times = np.asarray(times, dtype='datetime64[s]')
+    args = _astronomical_arguments(times)
+    corrections = _node_corrections(args['N'])
+    coefficients = np.array([V_COEFFICIENTS[c] for c in CONSTITUENTS], dtype='float64')
+    angles = np.stack([args['T'], args['s'], args['h'], args['p'], args['p1'], np.ones_like(args['T'])])
+    v = coefficients @ angles
+    f = np.stack([corrections[c][0] for c in CONSTITUENTS])
+    u = np.stack([corrections[c][1] for c in CONSTITUENTS])
+    astro = f * np.exp(1j * np.radians(np.mod(v + u, 360.0)))
+
+    amplitudes = np.array([[h.amplitudes.get(c, 0.0) for c in CONSTITUENTS] for h in harmonics])
+    phases = np.array([[h.phases.get(c, 0.0) for c in CONSTITUENTS] for h in harmonics])
+    station_terms = amplitudes * np.exp(-1j * np.radians(phases))
+    velocities = (station_terms @ astro).real
+    means = np.array([h.mean for h in harmonics])[:, None]
+    signs = np.array([h.flood_sign for h in harmonics])[:, None]
+    return signs * (velocities + means)
+
+
+@dataclass
+class CurrentEvents:
+    times: np.ndarray  # datetime64[s], UTC
+    events: np.ndarray  # 'slack', 'flood' or 'ebb'
+    knots: np.ndarray  # NaN for slack
+
+
+def find_events(times: np.ndarray, velocities: np.ndarray) -> CurrentEvents:
+    # Slacks at zero crossings (linearly interpolated), max flood/ebb at local extrema of |v| (parabolic vertex)
+    times = np.asarray(times, dtype='datetime64[s]')
+    t = (times - times[0]).astype('float64')
+    v = velocities
+
+    crossing = np.nonzero(np.signbit(v[:-1]) != np.signbit(v[1:]))[0]
+    frac = v[crossing] / (v[crossing] - v[crossing + 1])
+    slack_t = t[crossing] + frac * (t[crossing + 1] - t[crossing])
+
+    speed = np.abs(v)
+    peak = np.nonzero((speed[1:-1] > speed[:-2]) & (speed[1:-1] >= speed[2:]))[0] + 1
+    y0, y1, y2 = v[peak - 1], v[peak], v[peak + 1]
+    denom = y0 - 2 * y1 + y2
+    offset = np.divide(0.5 * (y0 - y2), denom, out=np.zeros_like(denom), where=denom != 0)
+    step = t[peak + 1] - t[peak]
+    peak_t = t[peak] + offset * step
+    peak_v = y1 - 0.25 * (y0 - y2) * offset
+
+    event_t = np.concatenate([slack_t, peak_t])
+    event_kind = np.concatenate([np.full(len(slack_t), 'slack', dtype=object),
+                                 np.where(peak_v > 0, 'flood', 'ebb').astype(object)])
+    event_knots = np.concatenate([np.full(len(slack_t), np.nan), peak_v])
+    order = np.argsort(event_t, kind='stable')
+    event_times = times[0] + np.round(event_t[order]).astype('timedelta64[s]')
+    return CurrentEvents(event_times, event_kind[order], event_knots[order])
+
+
+def _utc_grid(start: pendulum.DateTime, end: pendulum.DateTime, step_minutes: int) -> np.ndarray:
+    # Pad by a step on each side so events right at the boundaries are still bracketed
+    start_utc = np.datetime64(int(start.in_timezone('UTC').timestamp()), 's')
+    end_utc = np.datetime64(int(end.in_timezone('UTC').timestamp()), 's')
+    step = np.timedelta64(step_minutes * 60, 's')
+    return np.arange(start_utc - step, end_utc + 2 * step, step)
+
+
+def _events_table(events: CurrentEvents, start: pendulum.DateTime, end: pendulum.DateTime) -> pd.DataFrame:
+    local = pd.DatetimeIndex(events.times).tz_localize('UTC').tz_convert(LOCAL_TIMEZONE)
+    keep = (local >= pd.Timestamp(start.isoformat())) & (local < pd.Timestamp(end.isoformat()))
+    return pd.DataFrame({
+        DATETIME_COL: local[keep].strftime(CSV_DATETIME_FMT),
+        EVENT_COL: events.events[keep],
+        SPEED_COL: np.round(events.knots[keep], 2),
+    })
+
+
+def predict_currents_tables(
+        harmonics: Sequence[CurrentHarmonics],
+        date: str | pendulum.DateTime | None = None,
+        days: int = 2,
+        step_minutes: int = DEFAULT_STEP_MINUTES,
+) -> Dict[str, CurrentsPredictions]:
+    # Same shape as retrieve_currents_table output, computed locally for every station in one synthesis
+    if date is None:
+        date = pendulum.today(LOCAL_TIMEZONE)
+    elif isinstance(date, str):
+        date = pendulum.parse(date, tz=LOCAL_TIMEZONE)
+    start = date.in_timezone(LOCAL_TIMEZONE).start_of('day')
+    end = start.add(days=days)
+    times = _utc_grid(start, end, step_minutes)
+    velocities = predict_velocities(harmonics, times)
+    predictions = {}
+    for h, v in zip(harmonics, velocities):
+        table = _events_table(find_events(times, v), start, end)
+        predictions[h.station_id] = CurrentsPredictions(table, station_link(h.station_id))
+    return predictions
+
+
+def predict_currents_table(
+        station_id: str,
+        date: str | pendulum.DateTime | None = None,
+        days: int = 2,
+        harmonics: Optional[CurrentHarmonics] = None,
+) -> CurrentsPredictions:
+    if harmonics is None:
+        harmonics = load_harmonics(station_id)
+    return predict_currents_tables([harmonics], date=date, days=days)[harmonics.station_id]
+
+
+def compare_to_noaa(computed: CurrentsPredictions, reference: CurrentsPredictions) -> pd.DataFrame:
+    # Pairs each NOAA event with the nearest computed event of the same kind, for parity checks against saved CSVs
+    ref = reference.parsed.events.reset_index()
+    ours = computed.parsed.events.reset_index().rename(columns={'datetime': 'computed_time', 'knots': 'computed_knots'})
+    matched = pd.merge_asof(ref, ours[['computed_time', 'stage', 'computed_knots']], left_on='datetime',
+                            right_on='computed_time', by='stage', direction='nearest')
+    matched['time_diff_minutes'] = (matched['computed_time'] - matched['datetime']).dt.total_seconds() / 60
+    matched['knots_diff'] = matched['computed_knots'] - matched['knots']
+    return matched[['datetime', 'stage', 'knots', 'computed_knots', 'time_diff_minutes', 'knots_diff']]
+
+
+"""----------------------------------------------------------------------------
+SCRIPT CODE
+----------------------------------------------------------------------------"""
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('--station', type=str, default=default_nykp_station.id)
+    parser.add_argument('--date', type=str, default=None)
+    parser.add_argument('--days', type=int, default=2)
+    parser.add_argument('--harmonics', type=str, default=None, help='Path to a saved NOAA harcon.json')
+    return parser
+
+
+def main(args):
+    harmonics = load_harmonics(args.station, path=args.harmonics)
+    if harmonics.ignored:
+        print(f"Ignoring unsupported constituents: {', '.join(harmonics.ignored)}")
+    predictions = predict_currents_table(args.station, date=args.date, days=args.days, harmonics=harmonics)
+    days = predictions.parsed.format_days()
+    for d, txt in days.items():
+        print(f'{d}\n{txt}\n')
+
+
+if __name__ == '__main__':
+    parser = parse_args()
+    try_main(main, parser)
@@ -0,0 +1,161 @@
+from argparse import ArgumentParser
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import pendulum
+
+from noaa_currents import (CurrentsPredictions, ParsedPredictions, Station, default_nykp_station,
+                           localize_wall_times, retrieve_currents_tables)
+from utils.scripts import try_main
+from utils.units import MPH_PER_KNOT
+
+LOCAL_TIMEZONE = 'America/New_York'  # NOAA's LST/LDT times for the NY harbor stations
+
+
+def signed_knots(events: pd.DataFrame) -> np.ndarray:
+    # Flood positive, ebb negative, slack zero, whatever sign convention the speeds came with
+    stage = events['stage'].astype(str).str.lower()
+    is_slack = stage.str.contains('slack').to_numpy()
+    is_flood = stage.str.contains('flood').to_numpy() & ~is_slack
+    is_ebb = stage.str.contains('ebb').to_numpy() & ~is_slack
+    speed = np.abs(events['knots'].to_numpy(dtype='float64'))
+    return np.select([is_slack, is_flood, is_ebb], [0.0, speed, -speed], default=np.nan)
+
+
+def to_epoch_seconds(times, tz: str = LOCAL_TIMEZONE) -> np.ndarray:
+    # Unix seconds for datetimes, Timestamps or datetime64s; naive times are taken as `tz` local time, in the order
+    # they happen (see localize_wall_times for the hour repeated at the end of DST)
+    index = pd.DatetimeIndex(np.atleast_1d(times) if not isinstance(times, pd.Index) else times)
+    if index.tz is None:
+        index = localize_wall_times(index, tz)
+    return index.tz_convert('UTC').tz_localize(None).to_numpy(dtype='datetime64[s]').astype('int64')
+
+
+class CurrentsIndex:
+    # Current velocity at any time, for many stations at once, from predicted slack/max events. Velocity between two
+    # consecutive events follows half a cosine (NOAA's usual assumption for the shape of the tidal current curve).
+    #
+    # All stations' events live in one sorted array, each station shifted into its own block of the key space, so
+    # a (stations x times) query is a single searchsorted no matter how many stations there are.
+
+    def __init__(self, events: Dict[str, pd.DataFrame], tz: str = LOCAL_TIMEZONE):
+        # events: station id -> ParsedPredictions.events
+        self.tz = tz
+        self.stations: List[str] = list(events)
+        times, knots = [], []
+        for station_id in self.stations:
+            station_events = events[station_id]
+            t = to_epoch_seconds(station_events.index, tz=tz) if len(station_events) else np.empty(0, dtype='int64')
+            v = signed_knots(station_events) if len(station_events) else np.empty(0)
+            ok = np.isfinite(v)  # Drops unknown stages
+            t, v = t[ok], v[ok]
+            order = np.argsort(t, kind='stable')
+            t, v = t[order], v[order]
+            # Events repeated where fetched chunks overlap
+            keep = np.concatenate([[True], np.diff(t) > 0]) if len(t) else np.empty(0, dtype=bool)
+            times.append(t[keep])
+            knots.append(v[keep])
+
+        non_empty = [t for t in times if len(t)]
+        self._t0 = min(t[0] for t in non_empty) if non_empty else 0
+        stride = (max(t[-1] for t in non_empty) - self._t0 + 1) if non_empty else 1
+        counts = np.array([len(t) for t in times])
+        self._offsets = np.arange(len(times), dtype='float64') * stride
+        self._first_idx = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype('int64')
+        self._last_idx = self._first_idx + counts - 1
+        self._first_t = np.array([t[0] if len(t) >= 2 else np.inf for t in times], dtype='float64')
+        self._last_t = np.array([t[-1] if len(t) >= 2 else -np.inf for t in times], dtype='float64')
+        self._keys = np.concatenate([(t - self._t0) + off for t, off in zip(times, self._offsets)] or [np.empty(0)])
+        self._knots = np.concatenate(knots or [np.empty(0)])
+        self._row = {station_id: i for i, station_id in enumerate(self.stations)}
+
+    @classmethod
+    def from_predictions(
+            cls, predictions: Dict[str, CurrentsPredictions], tz: str = LOCAL_TIMEZONE
+    ) -> 'CurrentsIndex':
+        return cls({station_id: p.parsed.events for station_id, p in predictions.items()}, tz=tz)
+
+    @classmethod
+    def from_tables(cls, tables: pd.DataFrame, tz: str = LOCAL_TIMEZONE) -> 'CurrentsIndex':
+        # `tables` as returned by retrieve_currents_tables, with a 'station' index level
+        return cls({station_id: ParsedPredictions.from_table(table.reset_index(drop=True)).events
+                    for station_id, table in tables.groupby(level='station', sort=False)}, tz=tz)
+
+    @classmethod
+    def fetch(cls, stations: Sequence[Station], start=None, end=None) -> 'CurrentsIndex':
+        # The last event of `end` needs the first of the next day to interpolate towards
+        if isinstance(end, str):
+            end = pendulum.parse(end, tz=LOCAL_TIMEZONE)
+        if end is not None:
+            end = end.add(days=1)
+        return cls.from_tables(retrieve_currents_tables(stations, start=start, end=end))
+
+    def coverage(self, station_id: str) -> (Optional[pd.Timestamp], Optional[pd.Timestamp]):
+        row = self._row[station_id]
+        if not np.isfinite(self._first_t[row]):
+            return None, None
+        return tuple(pd.Timestamp(int(t), unit='s', tz='UTC').tz_convert(self.tz)
+                     for t in (self._first_t[row], self._last_t[row]))
+
+    def knots_at_epoch(self, t: np.ndarray, stations: Optional[Sequence[str]] = None) -> np.ndarray:
+        # (stations x times) velocities in knots, flood positive; NaN outside a station's predicted events
+        rows = np.array([self._row[s] for s in (self.stations if stations is None else stations)], dtype='int64')
+        t = np.asarray(t, dtype='float64')[None, :]
+        if len(self._keys) == 0:
+            return np.full((len(rows), t.shape[1]), np.nan)
+        first_t, last_t = self._first_t[rows][:, None], self._last_t[rows][:, None]
+        valid = (t >= first_t) & (t <= last_t)
+        # Out-of-range times get searched at the start of the station's own block, then masked
+        offsets = self._offsets[rows][:, None]
+        keys = np.where(valid, t - self._t0 + offsets, offsets)
+        lo = np.searchsorted(self._keys, keys, side='right') - 1
+        lo = np.clip(lo, self._first_idx[rows][:, None], self._last_idx[rows][:, None] - 1)
+        lo = np.clip(lo, 0, max(len(self._keys) - 2, 0))
+        hi = np.minimum(lo + 1, len(self._keys) - 1)
+        k0, k1 = self._keys[lo], self._keys[hi]
+        v0, v1 = self._knots[lo], self._knots[hi]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(k1 > k0, (keys - k0) / (k1 - k0), 0.0)
+        knots = v0 + (v1 - v0) * (1 - np.cos(np.pi * frac)) / 2
+        return np.where(valid, knots, np.nan)
+
+    def knots_at(self, times, stations: Optional[Sequence[str]] = None) -> np.ndarray:
+        return self.knots_at_epoch(to_epoch_seconds(times, tz=self.tz), stations=stations)
+
+    def at(self, times, stations: Optional[Sequence[str]] = None, mph: bool = False) -> pd.DataFrame:
+        # Times down the index, one column per station
+        stations = self.stations if stations is None else list(stations)
+        index = pd.DatetimeIndex(np.atleast_1d(times) if not isinstance(times, pd.Index) else times)
+        values = self.knots_at(index, stations=stations).T
+        if mph:
+            values = values * MPH_PER_KNOT
+        return pd.DataFrame(values, index=index, columns=stations)
+
+    def current_at(self, station_id: str, t) -> float:
+        return float(self.knots_at([t], stations=[station_id])[0, 0])
+
+
+"""----------------------------------------------------------------------------
+SCRIPT CODE
+----------------------------------------------------------------------------"""
+
+
+def parse_args():
+    parser = ArgumentParser(description='Predicted current (knots, flood positive) at given local times')
+    parser.add_argument('times', nargs='+', help="Local times, e.g. '2024-06-01 14:20'")
+    parser.add_argument('--station', type=str, default=default_nykp_station.id)
+    return parser
+
+
+def main(args):
+    times = pd.DatetimeIndex(pd.to_datetime(args.times, format='mixed'))
+    start = pendulum.instance(times.min().to_pydatetime(), tz=LOCAL_TIMEZONE).subtract(days=1)
+    end = pendulum.instance(times.max().to_pydatetime(), tz=LOCAL_TIMEZONE)
+    index = CurrentsIndex.fetch([Station(args.station, args.station)], start=start, end=end)
+    print(index.at(times).to_string(float_format=lambda k: f'{k:+.2f}'))
+
+
+if __name__ == '__main__':
+    parser = parse_args()
+    try_main(main, parser)
@@ -0,0 +1,198 @@
+import signal
+import threading
+import time
+import traceback
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from datetime import datetime, time as dt_time, timedelta
+from typing import Callable, Dict, List, Optional
+
+import pytz
+
+from sources import SOURCES
+from utils.metrics import metrics, source_context
+from utils.post_dedup import PostDedupStore
+from utils.scripts import str2bool, try_main
+from utils.slack import NykpSlackChannels, SlackPost, SlackPostQueue
+
+DAEMON_TZ = pytz.timezone('America/New_York')
+
+# Seconds between runs of each source
+DEFAULT_INTERVALS = {
+    'advisories': 5 * 60,
+    'precip': 60 * 60,
+    'water-temp': 60 * 60,
+    'forecast': 3 * 60 * 60,
+    'currents': 24 * 60 * 60,
+}
+# Local time of day for sources that run once a day, instead of counting from startup
+DEFAULT_DAILY_AT = {
+    'currents': '06:00',
+}
+
+
+@dataclass
+class Job:
+    name: str
+    interval: float
+    run: Callable[[], None]
+    at: Optional[str] = None  # 'HH:MM' local time, for daily jobs
+    next_run: float = 0.0  # Unix time
+
+    def schedule_next(self, now: float):
+        if self.at is None:
+            self.next_run = now + self.interval
+            return
+        hour, minute = map(int, self.at.split(':'))
+        # Localized per date, so the offset is that day's and not today's across a DST change
+        target_date = datetime.fromtimestamp(now, tz=DAEMON_TZ).date()
+        next_dt = DAEMON_TZ.localize(datetime.combine(target_date, dt_time(hour, minute)))
+        if next_dt.timestamp() <= now:
+            next_dt = DAEMON_TZ.localize(datetime.combine(target_date + timedelta(days=1), dt_time(hour, minute)))
+        self.next_run = next_dt.timestamp()
+
+
+class ConditionsDaemon:
+    # Runs each source on its own schedule in one long-lived process. Everything that makes a cron run slow to start
+    # stays warm between runs: imported modules, the Slack client and post queue, the HTTP session and cache index,
+    # resolved forecast grid points, and the advisory poller's seen-set and validators. With a dedup store, runs
+    # whose output hasn't changed since the last one don't post at all.
+
+    def __init__(
+            self,
+            channel: str,
+            intervals: Optional[Dict[str, float]] = None,
+            daily_at: Optional[Dict[str, str]] = None,
+            days: int = 1,
+            metrics_dir: Optional[str] = None,
+            dedup: Optional[PostDedupStore] = None,
+    ):
+        self.channel = channel
+        self.days = days
+        self.metrics_dir = metrics_dir
+        intervals = DEFAULT_INTERVALS if intervals is None else intervals
+        daily_at = DEFAULT_DAILY_AT if daily_at is None else daily_at
+        self.post_queue = SlackPostQueue(dedup=dedup)
+        self._poller = None
+        self._stop = threading.Event()
+        self.jobs = [Job(name, interval, self._job(name), at=daily_at.get(name))
+                     for name, interval in intervals.items()]
+
+    def _job(self, name: str) -> Callable[[], None]:
+        if name not in SOURCES:
+            raise ValueError(f"Unknown source {name!r}, expected one of: {', '.join(SOURCES)}")
+        if name == 'advisories':
+            return self._post_new_advisories
+        render = SOURCES[name].renderer(days=self.days)
+        return lambda: self._post(render())
+
+    def _post(self, posts: List[SlackPost]):
+        futures = [self.post_queue.submit(post, self.channel) for post in posts]
+        for f in futures:
+            f.result()
+
+    def _post_new_advisories(self):
+        # Only advisories that haven't been posted yet, rather than re-posting the last day's every few minutes
+        from notify_nyc import AdvisoryPoller, post_new_waterbody_advisories
+        if self._poller is None:
+            self._poller = AdvisoryPoller()
+        post_new_waterbody_advisories(self.channel, poller=self._poller, days=self.days, post_queue=self.post_queue)
+
+    def run_job(self, job: Job):
+        metrics.reset(script=f'daemon_{job.name}')
+        success = False
+        try:
+            with source_context(job.name), metrics.span('main'):
+                job.run()
+            success = True
+        except Exception:
+            # One source failing shouldn't take the others down; it just tries again next time
+            print(f'{job.name} failed:')
+            traceback.print_exc()
+        finally:
+            if self.metrics_dir:
+                metrics.export(self.metrics_dir, success=success)
+
+    def run(self, once: bool = False):
+        if threading.current_thread() is threading.main_thread():
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(sig, lambda signum, frame: self.stop())
+        now = time.time()
+        for job in self.jobs:
+            if job.at is None:
+                job.next_run = now
+            else:
+                job.schedule_next(now)
+        try:
+            while not self._stop.is_set():
+                job = min(self.jobs, key=lambda j: j.next_run)
+                if once and job.at is not None:
+                    job.next_run = time.time()
+                if self._stop.wait(timeout=max(job.next_run - time.time(), 0)):
+                    break
+                self.run_job(job)
+                job.schedule_next(time.time())
+                if once:
+                    self.jobs.remove(job)
+                    if not self.jobs:
+                        break
+        finally:
+            # Let queued posts finish before exiting
+            self.post_queue.close()
+
+    def stop(self):
+        self._stop.set()
+
+
+"""----------------------------------------------------------------------------
+SCRIPT CODE
+----------------------------------------------------------------------------"""
+
+
+def _parse_assignments(assignments: List[str], convert: Callable[[str], object]) -> Dict[str, object]:
+    parsed = {}
+    for assignment in assignments:
+        name, _, value = assignment.partition('=')
+        if name not in SOURCES or not value:
+            raise ValueError(f"Expected SOURCE=VALUE with SOURCE one of {', '.join(SOURCES)}, got {assignment!r}")
+        parsed[name] = convert(value)
+    return parsed
+
+
+def parse_args():
+    parser = ArgumentParser(description='Post conditions on a per-source schedule from one long-running process')
+    parser.add_argument('sources', nargs='*', help=f"Any of: {', '.join(DEFAULT_INTERVALS)} (default: all enabled)")
+    parser.add_argument('--channel', type=str, default=NykpSlackChannels.test_python_api)
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--interval', action='append', default=[], metavar='SOURCE=SECONDS',
+                        help='Override how often a source runs')
+    parser.add_argument('--at', action='append', default=[], metavar='SOURCE=HH:MM',
+                        help='Run a source once a day at this local time')
+    parser.add_argument('--once', action='store_true', help='Run each source once, then exit')
+    parser.add_argument('--dedup', type=str2bool, default=True, help='Skip posts unchanged since the last run')
+    parser.add_argument('--edit-changed', type=str2bool, default=False,
+                        help='With --dedup, edit the previous message in place when its content changed')
+    return parser
+
+
+def main(args):
+    unknown = set(args.sources) - set(SOURCES)
+    if unknown:
+        raise ValueError(f"Unknown sources: {', '.join(sorted(unknown))}")
+    names = args.sources or [name for name, source in SOURCES.items() if source.default_enabled]
+    overrides = _parse_assignments(args.interval, float)
+    intervals = {name: overrides.get(name, DEFAULT_INTERVALS.get(name, 60 * 60)) for name in names}
+    # An explicit interval replaces a source's default time of day
+    daily_at = {name: at for name, at in DEFAULT_DAILY_AT.items() if name not in overrides}
+    daily_at.update(_parse_assignments(args.at, str))
+    # Per-job metrics replace try_main's single end-of-run export
+    metrics_dir, args.metrics_dir = args.metrics_dir, None
+    dedup = PostDedupStore(edit_changed=args.edit_changed) if args.dedup else None
+    daemon = ConditionsDaemon(args.channel, intervals=intervals, daily_at=daily_at, days=args.days,
+                              metrics_dir=metrics_dir, dedup=dedup)
+    daemon.run(once=args.once)
+
+
+if __name__ == '__main__':
+    parser = parse_args()
+    try_main(main, parser)
@@ -1,21 +1,32 @@
-import os
+import io
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Optional, Sequence
-from urllib.request import urlretrieve
+from functools import cached_property
+from typing import Dict, List, Optional, Sequence
 
+import numpy as np
 import pandas as pd
 import pendulum
 
 from utils.data import rename_cols
-from utils.scripts import try_main
-from utils.slack import NykpSlackChannels, post_message, post_file
-from utils.units import knots_to_mph
+from utils.http_cache import cached_read
+from utils.metrics import propagate_source, timed
+from utils.post_dedup import PostDedupStore, resolve_dedup
+from utils.scripts import str2bool, try_main
+from utils.slack import NykpSlackChannels, SlackPost, send_post
+from utils.units import MPH_PER_KNOT
 
 CURRENTS_CSV_URL_BASE = 'https://tidesandcurrents.noaa.gov/noaacurrents/DownloadPredictions?'
 CURRENTS_CSV_DATE_FMT = 'YYYY-MM-DD'
+STATION_LINK_TEMPLATE = 'https://tidesandcurrents.noaa.gov/noaacurrents/Predictions?id={id}'
 ONE_WEEK_STRS = ('w', '1w')
 TWO_DAY_STRS = ('48h', '2d')
+DATETIME_COL = 'Date_Time (LST/LDT)'
+EVENT_COL = 'Event'
+SPEED_COL = 'Speed (knots)'
+CURRENTS_CSV_COLUMNS = (DATETIME_COL, EVENT_COL, SPEED_COL)
+CSV_DATETIME_FMT = '%Y-%m-%d %I:%M %p'  # With t=am/pm
 
 
 @dataclass
@@ -24,6 +35,16 @@ class CurrentsPredictions:
     link: str
     plot_img_path: Optional[str] = None
 
+    @cached_property
+    def parsed(self) -> 'ParsedPredictions':
+        return ParsedPredictions.from_table(self.table)
+
+    @cached_property
+    def compact(self) -> 'CompactPredictions':
+        # Typed arrays instead of the table's strings, for holding many stations' predictions at once
+        from currents_archive import CompactPredictions
+        return CompactPredictions.from_table(self.table)
+
 
 def _starts_with_one_of(s: str, candidates: str | Sequence[str], ignore_case=True) -> bool:
     if isinstance(candidates, str):
@@ -53,11 +74,26 @@ def parse_time_period(r: None | int | str) -> int:
     return 1
 
 
+def station_link(station_id: str) -> str:
+    return STATION_LINK_TEMPLATE.format(id=station_id)
+
+
+@timed('parse')
+def parse_currents_csv(body: bytes) -> pd.DataFrame:
+    # Header names sometimes come padded with whitespace, so match them after stripping
+    df = pd.read_csv(io.BytesIO(body), usecols=lambda col: col.strip() in CURRENTS_CSV_COLUMNS, dtype=str,
+                     skipinitialspace=True)
+    df = df.rename(columns=str.strip)
+    if SPEED_COL in df:
+        # Slack rows have no speed
+        df[SPEED_COL] = pd.to_numeric(df[SPEED_COL], errors='coerce')
+    return df
+
+
 def retrieve_currents_table(
         station_id: str,
         date: str | pendulum.DateTime | None = None,
         time_period=None,
-        delete=True,
 ) -> CurrentsPredictions:
     if date is None:
         date = pendulum.today()
@@ -73,17 +109,8 @@ def retrieve_currents_table(
                       'id': station_id,
                       't': 'am%2fpm'}
     csv_url = CURRENTS_CSV_URL_BASE + '&'.join([f"{k}={v}" for k, v in csv_url_params.items()])
-    csv_filename = f"current_predictions_{station_id}_{date}.csv"
-    station_link = f"https://tidesandcurrents.noaa.gov/noaacurrents/Predictions?id={station_id}"
-    (_, msg) = urlretrieve(csv_url, csv_filename)
-    try:
-        df = pd.read_csv(csv_filename)
-    except:
-        print(msg)
-        raise
-    if delete:
-        os.remove(csv_filename)
-    return CurrentsPredictions(df, station_link)
+    df = parse_currents_csv(cached_read(csv_url, source='noaa_currents'))
+    return CurrentsPredictions(df, station_link(station_id))
 
 
 @dataclass
@@ -97,44 +124,179 @@ HUDSON_RIVER_PIER_92 = Station('Hudson River, Pier 92', 'NYH1928', '6 feet')
 HUDSON_RIVER_ENTRANCE = Station('Hudson River Entrance', 'NYH1927_13')
 default_nykp_station = HUDSON_RIVER_PIER_92
 
+WEEKLY_PERIOD = 2  # The longest range the download endpoint serves per request
+DAYS_PER_WEEKLY_REQUEST = 7
+DEFAULT_MAX_IN_FLIGHT = 6
+CURRENTS_TIMEZONE = 'America/New_York'  # Every request asks for LST/LDT, the NY harbor stations' local time
+
+
+def as_local_date(d: str | pendulum.DateTime | None) -> pendulum.DateTime:
+    # Midnight local time on the day `d` falls on there, so ranges given in any timezone line up with the CSV dates
+    if d is None:
+        return pendulum.today(CURRENTS_TIMEZONE)
+    if isinstance(d, str):
+        d = pendulum.parse(d, tz=CURRENTS_TIMEZONE)
+    return d.in_timezone(CURRENTS_TIMEZONE).start_of('day')
+
+
+def localize_wall_times(times, tz: str = CURRENTS_TIMEZONE) -> pd.DatetimeIndex:
+    # Naive local times, in the order they happen, made tz-aware. In the hour that repeats when the clocks go back, a
+    # time is taken as daylight time unless that would put it before the one preceding it, i.e. the wall clock went
+    # backwards, so it's standard time from there on. Times skipped when the clocks go forward move past the gap.
+    index = pd.DatetimeIndex(times)
+    as_dst = index.tz_localize(tz, ambiguous=np.ones(len(index), dtype=bool), nonexistent='shift_forward')
+    as_std = index.tz_localize(tz, ambiguous=np.zeros(len(index), dtype=bool), nonexistent='shift_forward')
+    utc = as_dst.tz_convert('UTC').tz_localize(None).to_numpy(dtype='datetime64[ns]')
+    std_utc = as_std.tz_convert('UTC').tz_localize(None).to_numpy(dtype='datetime64[ns]')
+    for i in np.flatnonzero(utc != std_utc):  # Only the few times in a repeated hour
+        if i > 0 and utc[i] < utc[i - 1]:
+            utc[i] = std_utc[i]
+    return pd.DatetimeIndex(utc, name=index.name).tz_localize('UTC').tz_convert(tz)
+
+
+def _chunk_rows(table: pd.DataFrame, first: str, last: str) -> pd.DataFrame:
+    # Rows dated first..last (YYYY-MM-DD, inclusive). Each chunk keeps only its own days, so rows repeated where
+    # neighbouring weekly responses overlap come from exactly one of them, while both of the repeated wall-clock
+    # times at the end of DST stay.
+    dates = table[DATETIME_COL].str.split(' ', n=1).str[0]
+    return table[(dates >= first) & (dates <= last)]
+
+
+def retrieve_currents_tables(
+        stations: Sequence[Station],
+        start: str | pendulum.DateTime | None = None,
+        end: str | pendulum.DateTime | None = None,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+) -> pd.DataFrame:
+    # Predictions for every day from start to end (inclusive, local dates), any length of range, as one table
+    # indexed by (station, row). Fetched as weekly requests, all stations' in parallel, and stitched in time order.
+    start = as_local_date(start)
+    end = start if end is None else as_local_date(end)
+    if end < start:
+        raise ValueError(f'End date {end} is before start date {start}')
+
+    # One weekly request per station per 7 days in the range
+    n_requests = (end - start).days // DAYS_PER_WEEKLY_REQUEST + 1
+    request_dates = [start.add(days=DAYS_PER_WEEKLY_REQUEST * i) for i in range(n_requests)]
+    jobs = [(station, d) for station in stations for d in request_dates]
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        retrieve = propagate_source(retrieve_currents_table)
+        futures = [executor.submit(retrieve, station.id, d, WEEKLY_PERIOD) for station, d in jobs]
+        tables = [f.result().table for f in futures]
+
+    last_date = end.format(CURRENTS_CSV_DATE_FMT)
+    by_station = {}
+    for (station, d), table in zip(jobs, tables):
+        chunk_last = min(d.add(days=DAYS_PER_WEEKLY_REQUEST - 1).format(CURRENTS_CSV_DATE_FMT), last_date)
+        by_station.setdefault(station.id, []).append(_chunk_rows(table, d.format(CURRENTS_CSV_DATE_FMT), chunk_last))
+    return pd.concat({station_id: pd.concat(dfs, ignore_index=True) for station_id, dfs in by_station.items()},
+                     names=['station', None])
+
+
+def retrieve_currents_range(
+        station_id: str,
+        start: str | pendulum.DateTime | None = None,
+        end: str | pendulum.DateTime | None = None,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+) -> CurrentsPredictions:
+    # retrieve_currents_table for any start..end range instead of 48 hours or a week from one date
+    tables = retrieve_currents_tables([Station(station_id, station_id)], start=start, end=end,
+                                      max_in_flight=max_in_flight)
+    return CurrentsPredictions(tables.loc[station_id].reset_index(drop=True), station_link(station_id))
+
+
+COL_RENAMES = {DATETIME_COL: 'datetime', EVENT_COL: 'stage', SPEED_COL: 'knots'}
+TABLE_TIME_FMT = '%I:%M %p'
+TABLE_DATE_FMT = '%Y-%m-%d'
+
+
+@dataclass
+class ParsedPredictions:
+    # Events indexed by datetime64, with columns stage, knots and mph
+    events: pd.DataFrame
+
+    @classmethod
+    def from_table(cls, table: pd.DataFrame) -> 'ParsedPredictions':
+        df = rename_cols(table, COL_RENAMES)
+        knots = pd.to_numeric(df['knots'], errors='coerce').to_numpy(dtype='float64')
+        local = pd.DatetimeIndex(pd.to_datetime(df['datetime'], format=CSV_DATETIME_FMT), name='datetime')
+        events = pd.DataFrame(
+            {'stage': df['stage'].to_numpy(), 'knots': knots, 'mph': knots * MPH_PER_KNOT},
+            index=local,
+        )
+        # In the order they happen, which the wall-clock times alone don't give in the hour repeated at the end of
+        # DST; this is the table's row order
+        order = np.argsort(localize_wall_times(local).asi8, kind='stable')
+        return cls(events.iloc[order])
+
+    @cached_property
+    def dates(self) -> List[str]:
+        return list(pd.unique(self.events.index.strftime(TABLE_DATE_FMT)))
+
+    def format_days(self, dates: Optional[Sequence[str]] = None) -> Dict[str, str]:
+        # One pass over all events, grouped by date
+        events = self.events
+        event_dates = events.index.strftime(TABLE_DATE_FMT)
+        if dates is not None:
+            keep = event_dates.isin(list(dates))
+            events, event_dates = events[keep], event_dates[keep]
+        mph = events['mph'].to_numpy()
+        has_speed = ~np.isnan(mph)
+        speed_txt = np.full(len(events), '', dtype=object)
+        speed_txt[has_speed] = np.char.mod(' (%.1f mph)', mph[has_speed])
+        times = events.index.strftime(TABLE_TIME_FMT).to_numpy(dtype=object)
+        lines = times + '  ' + events['stage'].astype(str).to_numpy(dtype=object) + speed_txt
+        by_date = pd.Series(lines).groupby(event_dates.to_numpy(), sort=False).agg('\n'.join)
+        return by_date.to_dict()
+
 
 def format_currents_table(df: pd.DataFrame, date=None) -> str:
     if date is None:
         date = pendulum.today()
     if not isinstance(date, str):
         date = date.format('YYYY-MM-DD')
-    col_renames = {'Date_Time (LST/LDT)': 'datetime',
-                   'Event': 'stage',
-                   'Speed (knots)': 'knots'}
-    df = rename_cols(df, col_renames)
-    df['date'] = df['datetime'].map(lambda dts: dts.split(' ')[0])
-    df['time'] = df['datetime'].map(lambda dts: ' '.join(dts.split(' ')[1:]))
-    df['mph'] = df['knots'].map(knots_to_mph)
-    text = ''
-    today_df = df[df['date'] == date]
-    for _, row in today_df.iterrows():
-        text += f"{row['time']}  "
-        text += row['stage']
-        if pd.notna(row['mph']):
-            text += f" ({row['mph']:.1f} mph)"
-        text += '\n'
-    return text.rstrip()
-
-
-def post_currents(channel: str, station: Optional[Station] = None, date=None, time_period=None, days=1) -> None:
+    return ParsedPredictions.from_table(df).format_days([date]).get(date, '')
+
+
+def render_currents(
+        station: Optional[Station] = None, date=None, time_period=None, days=1, offline=False
+) -> List[SlackPost]:
     if station is None:
         station = default_nykp_station
-    predictions = retrieve_currents_table(station_id=station.id, date=date, time_period=time_period)
-    dates = sorted(predictions.table['Date_Time (LST/LDT)'].map(lambda dt: dt.split(' ')[0]).unique())
-    dates = dates[:days]
-    post_txt = f"<{predictions.link}|NOAA current predictions at {station.name} (depth: {station.depth})>\n"
+    if offline:
+        # Computed locally from harmonic constituents, no NOAA predictions request
+        from currents_harmonics import predict_currents_table
+        predictions = predict_currents_table(station.id, date=date, days=max(days, 2))
+    elif days > DAYS_PER_WEEKLY_REQUEST:
+        start = as_local_date(date)
+        predictions = retrieve_currents_range(station.id, start=start, end=start.add(days=days - 1))
+    else:
+        predictions = retrieve_currents_table(station_id=station.id, date=date, time_period=time_period)
+    parsed = predictions.parsed
+    dates = sorted(parsed.dates)[:days]
+    tables = parsed.format_days(dates)
+    # Offline ones are our own synthesis, so they aren't passed off as NOAA's predictions
+    source = 'Current predictions computed from NOAA harmonic constituents' if offline else 'NOAA current predictions'
+    post_txt = f"<{predictions.link}|{source} at {station.name} (depth: {station.depth})>\n"
+    day_txts = []
     for d in dates:
-        table_txt = format_currents_table(predictions.table, date=d)
         date_str = pendulum.parse(d).format('dddd, MMMM D, YYYY')
-        post_txt += f"*{date_str}*\n{table_txt}"
-    response = post_message(post_txt, channel=channel, unfurl_links=False)
+        day_txts.append(f"*{date_str}*\n{tables.get(d, '')}")
+    post_txt += '\n\n'.join(day_txts)
+    posts = [SlackPost(text=post_txt, kwargs={'unfurl_links': False}, dedup_key=f'currents:{station.id}')]
     if predictions.plot_img_path:
-        file = post_file(predictions.plot_img_path, channel=channel)
+        posts.append(SlackPost(file=predictions.plot_img_path, dedup_key=f'currents:{station.id}:plot'))
+    return posts
+
+
+def post_currents(
+        channel: str, station: Optional[Station] = None, date=None, time_period=None, days=1, offline=False,
+        dedup: bool | PostDedupStore = True,
+) -> None:
+    dedup = resolve_dedup(dedup)
+    for post in render_currents(station=station, date=date, time_period=time_period, days=days, offline=offline):
+        send_post(post, channel, dedup=dedup)
 
 
 """----------------------------------------------------------------------------
@@ -149,6 +311,8 @@ def parse_args():
     parser.add_argument('--range', type=str, default=None)
     parser.add_argument('--channel', type=str, default=None)
     parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--offline', action='store_true', help='Compute predictions from harmonic constituents')
+    parser.add_argument('--dedup', type=str2bool, default=True, help='Skip posts unchanged since the last run')
     return parser
 
 
@@ -163,7 +327,8 @@ def main(args):
     else:
         station = None
 
-    post_currents(channel, station=station, date=args.date, time_period=args.range)
+    post_currents(channel, station=station, date=args.date, time_period=args.range, days=args.days,
+                  offline=args.offline, dedup=args.dedup)
 
 
 if __name__ == '__main__':
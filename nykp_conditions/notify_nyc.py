@@ -1,15 +1,24 @@
+import hashlib
+import json
+import os
+import time
+import traceback
 from argparse import ArgumentParser
 
 from dataclasses import dataclass, fields
 from datetime import datetime, timedelta
-from typing import List, Optional, Self
+from typing import Dict, List, Optional, Self, Tuple
 
 import feedparser
 import pendulum
 import pytz
 
-from utils.scripts import try_main
-from utils.slack import NykpSlackChannels, post_text_attachment
+from utils.http import get_transport
+from utils.http_cache import cached_read
+from utils.metrics import metrics
+from utils.post_dedup import PostDedupStore, resolve_dedup
+from utils.scripts import str2bool, try_main
+from utils.slack import NykpSlackChannels, SlackPost, SlackPostQueue, text_attachment_post
 
 
 NOTIFY_NYC_URL = 'https://a858-nycnotify.nyc.gov/RSS/NotifyNYC?lang=en'
@@ -17,6 +26,12 @@ WATERBODY_ADVISORY = 'Waterbody Advisory'
 ALERTS_FIELD = 'entries'
 NOTIFY_DATE_FMT = '%m/%d/%Y %H:%M:%S'
 NOTIFY_NYC_TZ = pytz.timezone('America/New_York')
+MAX_BLOCKS_PER_MESSAGE = 50
+MAX_SECTION_CHARS = 3000
+ADVISORIES_PER_BLOCKS_POST = MAX_BLOCKS_PER_MESSAGE // 2  # A section and a divider each
+SEEN_INDEX_PATH = os.path.abspath(os.path.join(__file__, '../../cache/notify_nyc_seen.json'))
+SEEN_RETENTION_DAYS = 30
+DEFAULT_POLL_SECONDS = 60
 
 
 def find_links(s: str) -> List[str]:
@@ -28,11 +43,12 @@ class NotifyAlert:
     title: str
     published: datetime
     summary: str
+    id: Optional[str] = None
 
     def __post_init__(self):
         if isinstance(self.published, str):
             try:
-                self.published = datetime.strptime(self.published, NOTIFY_DATE_FMT).replace(tzinfo=NOTIFY_NYC_TZ)
+                self.published = NOTIFY_NYC_TZ.localize(datetime.strptime(self.published, NOTIFY_DATE_FMT))
             except ValueError:
                 self.published = pendulum.parse(self.published)
 
@@ -42,6 +58,16 @@ class NotifyAlert:
         kws = {field: entry.get(field) for field in field_names}
         return cls(**kws)
 
+    @property
+    def key(self) -> str:
+        # Short stable hash of the GUID (or title + date when the feed leaves it out), for the seen-set
+        guid = self.id or f'{self.title}|{self.published}'
+        return hashlib.sha1(guid.encode()).hexdigest()[:16]
+
+
+def _is_waterbody_advisory(alert: NotifyAlert) -> bool:
+    return WATERBODY_ADVISORY in alert.title
+
 
 def get_waterbody_advisories(
         start_dt: datetime | None = None,
@@ -50,7 +76,7 @@ def get_waterbody_advisories(
 ) -> list[NotifyAlert]:
     
     def f(alert: NotifyAlert) -> bool:
-        if WATERBODY_ADVISORY not in alert.title:
+        if not _is_waterbody_advisory(alert):
             return False
         if start_dt and alert.published < start_dt:
             return False
@@ -58,17 +84,132 @@ def get_waterbody_advisories(
             return False
         return True
     
-    feed = feedparser.parse(url)
+    body = cached_read(url, source='notify_nyc')
+    with metrics.span('parse'):
+        feed = feedparser.parse(body)
     alerts = map(NotifyAlert.parse, feed[ALERTS_FIELD])
     return list(filter(f, alerts))
 
 
-def post_waterbody_advisories(
-        channel: str,
+class AdvisoryPoller:
+    # Polls the feed with If-None-Match/If-Modified-Since and only hands back advisories it hasn't seen before.
+    # Validators and seen GUID hashes (with first-seen time, pruned after SEEN_RETENTION_DAYS) persist in a JSON
+    # index. A poll only counts once commit() is called, so advisories that fail to post are retried next time;
+    # mark_seen() records ones that did post as they go, so a retry doesn't post them again.
+
+    def __init__(self, url: str = NOTIFY_NYC_URL, index_path: str = SEEN_INDEX_PATH):
+        self.url = url
+        self.index_path = index_path
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.body_hash: Optional[str] = None
+        self.seen: Dict[str, float] = {}
+        self._pending: Optional[dict] = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        self.etag = state.get('etag')
+        self.last_modified = state.get('last_modified')
+        self.body_hash = state.get('body_hash')
+        self.seen = state.get('seen', {})
+
+    def _save(self):
+        cutoff = time.time() - SEEN_RETENTION_DAYS * 24 * 60 * 60
+        self.seen = {k: t for k, t in self.seen.items() if t >= cutoff}
+        state = {'etag': self.etag, 'last_modified': self.last_modified, 'body_hash': self.body_hash,
+                 'seen': self.seen}
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        tmp_path = f'{self.index_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, separators=(',', ':'))
+        os.replace(tmp_path, self.index_path)
+
+    def poll(self, since: Optional[datetime] = None) -> List[NotifyAlert]:
+        # Advisories published before `since` are marked seen without being returned
+        self._pending = None
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        resp = get_transport().get(self.url, headers=headers)
+        if resp.status_code == 304:
+            return []
+        resp.raise_for_status()
+        body_hash = hashlib.sha1(resp.content).hexdigest()
+        self._pending = {'etag': resp.headers.get('ETag'), 'last_modified': resp.headers.get('Last-Modified'),
+                         'body_hash': body_hash, 'keys': []}
+        if body_hash == self.body_hash:
+            # Server doesn't do conditional requests, but nothing changed
+            return []
+
+        with metrics.span('parse'):
+            feed = feedparser.parse(resp.content)
+        new_alerts = []
+        for entry in feed[ALERTS_FIELD]:
+            alert = NotifyAlert.parse(entry)
+            if alert.key in self.seen:
+                continue
+            self._pending['keys'].append(alert.key)
+            if _is_waterbody_advisory(alert) and (since is None or alert.published >= since):
+                new_alerts.append(alert)
+        return sorted(new_alerts, key=lambda a: a.published)
+
+    def mark_seen(self, keys: List[str]):
+        # Saved right away, but the feed validators stay where they were until commit(), so the next poll still
+        # fetches the feed and picks up whatever from this one wasn't marked
+        now = time.time()
+        self.seen.update({key: now for key in keys})
+        if self._pending is not None:
+            self._pending['keys'] = [key for key in self._pending['keys'] if key not in self.seen]
+        self._save()
+
+    def commit(self):
+        if self._pending is None:
+            return
+        now = time.time()
+        self.seen.update({key: now for key in self._pending.pop('keys')})
+        for k, v in self._pending.items():
+            setattr(self, k, v)
+        self._pending = None
+        self._save()
+
+
+def _advisory_pretext(advisory: NotifyAlert) -> str:
+    pretext = f"{advisory.title} ({advisory.published})"
+    links = find_links(advisory.summary)
+    if links:
+        pretext += '\nLinks:\n' + '\n'.join(links)
+    return pretext
+
+
+def advisories_blocks_posts(advisories: List[NotifyAlert]) -> List[SlackPost]:
+    # Several advisories per Block Kit message, within Slack's per-message block limit
+    posts = []
+    per_post = ADVISORIES_PER_BLOCKS_POST
+    for i in range(0, len(advisories), per_post):
+        batch = advisories[i:(i + per_post)]
+        blocks = []
+        for advisory in batch:
+            text = f"*{_advisory_pretext(advisory)}*\n{advisory.summary}"
+            blocks.append({'type': 'section', 'text': {'type': 'mrkdwn', 'text': text[:MAX_SECTION_CHARS]}})
+            blocks.append({'type': 'divider'})
+        fallback = f"{len(batch)} waterbody advisories"
+        posts.append(SlackPost(text=fallback, kwargs={'blocks': blocks[:-1]}))
+    return posts
+
+
+def render_waterbody_advisories(
         start_time: Optional[datetime | str] = None,
         end_time: Optional[datetime | str] = None,
-        days=1
-):
+        days=1,
+        combine=False,
+) -> List[SlackPost]:
     if isinstance(end_time, str):
         end_time = pendulum.parse(end_time)
     elif end_time is None:
@@ -80,12 +221,71 @@ def post_waterbody_advisories(
         start_time = end_time - timedelta(days=days)
 
     advisories = get_waterbody_advisories(start_dt=start_time, end_dt=end_time)
-    for advisory in advisories:
-        pretext = f"{advisory.title} ({advisory.published})"
-        links = find_links(advisory.summary)
-        if links:
-            pretext += '\nLinks:\n' + '\n'.join(links) 
-        response = post_text_attachment(pretext=pretext, text=advisory.summary, channel=channel)
+    if combine and len(advisories) > 1:
+        return advisories_blocks_posts(advisories)
+    return [text_attachment_post(text=advisory.summary, pretext=_advisory_pretext(advisory))
+            for advisory in advisories]
+
+
+def post_waterbody_advisories(
+        channel: str,
+        start_time: Optional[datetime | str] = None,
+        end_time: Optional[datetime | str] = None,
+        days=1,
+        combine=False,
+        dedup: bool | PostDedupStore = True,
+):
+    # With dedup, advisories already posted to the channel by an earlier run aren't posted again
+    posts = render_waterbody_advisories(start_time=start_time, end_time=end_time, days=days, combine=combine)
+    with SlackPostQueue(dedup=resolve_dedup(dedup)) as post_queue:
+        futures = [post_queue.submit(post, channel) for post in posts]
+    return [f.result() for f in futures]
+
+
+def _new_advisory_posts(poller: AdvisoryPoller, combine=False, days=1) -> List[Tuple[SlackPost, List[str]]]:
+    # Each post with the seen-set keys of the advisories in it
+    # On a fresh index, don't flood the channel with the whole feed
+    since = datetime.now(tz=NOTIFY_NYC_TZ) - timedelta(days=days) if not poller.seen else None
+    advisories = poller.poll(since=since)
+    if combine and len(advisories) > 1:
+        batches = [advisories[i:(i + ADVISORIES_PER_BLOCKS_POST)]
+                   for i in range(0, len(advisories), ADVISORIES_PER_BLOCKS_POST)]
+        return [(post, [a.key for a in batch]) for post, batch in zip(advisories_blocks_posts(advisories), batches)]
+    return [(text_attachment_post(text=a.summary, pretext=_advisory_pretext(a)), [a.key]) for a in advisories]
+
+
+def render_new_waterbody_advisories(poller: AdvisoryPoller, combine=False, days=1) -> List[SlackPost]:
+    # Posts for advisories the poller hasn't seen; call poller.commit() once they're sent
+    return [post for post, _ in _new_advisory_posts(poller, combine=combine, days=days)]
+
+
+def post_new_waterbody_advisories(
+        channel: str, poller: Optional[AdvisoryPoller] = None, combine=False, days=1,
+        post_queue: Optional[SlackPostQueue] = None,
+):
+    # Each advisory is marked seen once its post has gone out. If any post fails, the error is raised after the rest
+    # are through and the poll isn't committed, so only the ones that failed are posted on the next try.
+    if poller is None:
+        poller = AdvisoryPoller()
+    posts = _new_advisory_posts(poller, combine=combine, days=days)
+    queue = SlackPostQueue() if post_queue is None else post_queue
+    try:
+        futures = [(queue.submit(post, channel), keys) for post, keys in posts]
+        responses, error = [], None
+        for future, keys in futures:
+            try:
+                responses.append(future.result())
+            except Exception as e:
+                error = error or e
+                continue
+            poller.mark_seen(keys)
+    finally:
+        if post_queue is None:
+            queue.close()
+    if error is not None:
+        raise error
+    poller.commit()
+    return responses
 
 
 """----------------------------------------------------------------------------
@@ -97,6 +297,12 @@ def parse_args():
     parser = ArgumentParser()
     parser.add_argument('--channel', type=str, default=None)
     parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--combine', action='store_true', help='Combine advisories into Block Kit messages')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only post advisories not seen on a previous run, instead of a time window')
+    parser.add_argument('--poll', type=float, default=None,
+                        help=f'With --incremental, keep polling every POLL seconds (e.g. {DEFAULT_POLL_SECONDS})')
+    parser.add_argument('--dedup', type=str2bool, default=True, help='Skip posts unchanged since the last run')
     return parser
 
 
@@ -105,7 +311,32 @@ def main(args):
         channel = args.channel
     else:
         channel = NykpSlackChannels.test_python_api
-    post_waterbody_advisories(channel, days=args.days)
+    if not args.incremental:
+        post_waterbody_advisories(channel, days=args.days, combine=args.combine, dedup=args.dedup)
+        return
+    poller = AdvisoryPoller()
+    if args.poll is None:
+        post_new_waterbody_advisories(channel, poller=poller, combine=args.combine, days=args.days)
+        return
+    # Per-poll metrics replace try_main's single end-of-run export, which a poller stopped by a signal never reaches
+    metrics_dir, args.metrics_dir = args.metrics_dir, None
+    script = metrics.script
+    while True:
+        metrics.reset(script=script)
+        success = False
+        try:
+            with metrics.span('main'):
+                post_new_waterbody_advisories(channel, poller=poller, combine=args.combine, days=args.days)
+            success = True
+        except Exception as e:
+            # A feed or Slack hiccup shouldn't end the poller; whatever didn't post is retried on the next poll
+            metrics.incr('notify_nyc_poll_errors', error=type(e).__name__)
+            print('Polling Notify NYC failed:')
+            traceback.print_exc()
+        finally:
+            if metrics_dir:
+                metrics.export(metrics_dir, success=success)
+        time.sleep(args.poll)
 
 
 if __name__ == '__main__':
@@ -1,50 +1,86 @@
-import itertools as it
+import importlib.util
+import json
 import os
+import threading
 from argparse import ArgumentParser
-from dataclasses import dataclass
-from datetime import datetime
-from typing import Tuple, Union
-from urllib.request import urlopen, urlretrieve
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Tuple, Union
 
-from bs4 import BeautifulSoup, Tag
-import pytz
+from bs4 import BeautifulSoup, SoupStrainer
 
 from utils.geo import LatLon
-from utils.scripts import try_main
-from utils.slack import NykpSlackChannels, post_message, post_file
+from utils.http import get_transport
+from utils.http_cache import cached_read, cached_retrieve
+from utils.images import DEFAULT_IMAGE_OUTPUT, ImageBudgetError, ImageOutput, compact_image
+from utils.metrics import metrics, propagate_source
+from utils.post_dedup import PostDedupStore, resolve_dedup
+from utils.scripts import str2bool, try_main
+from utils.slack import NykpSlackChannels, SlackPost, send_post
 
 URL_BASE = 'https://forecast.weather.gov/'
+API_URL_BASE = 'https://api.weather.gov'
+GRID_POINTS_PATH = os.path.abspath(os.path.join(__file__, '../../cache/nws_grid_points.json'))
 DEFAULT_LAT_LON = LatLon(40.7143, -74.006)
-CACHE_DIR = 'cache'
-IMG_FILENAME_TEMPLATE = 'nws_forecast_{lat}_{lon}_{ts}.png'
-_cleanup_paths = []
+FORECAST_IMG_SRC_PREFIX = 'meteograms/Plotter.php'
+HTML_PARSER = 'lxml' if importlib.util.find_spec('lxml') else 'html.parser'
 _LatLonType = Union[LatLon, Tuple[float, float]]
 
 
-def _is_forecast_img_tag(tag: Tag) -> bool:
-    return tag.attrs['src'].startswith('meteograms/Plotter.php')
+def _is_forecast_img_src(src: Optional[str]) -> bool:
+    return src is not None and src.startswith(FORECAST_IMG_SRC_PREFIX)
 
 
-def save_forecast_plot(lat_lon: _LatLonType = DEFAULT_LAT_LON) -> str:
-    if not isinstance(lat_lon, LatLon):
-        lat_lon = LatLon(*lat_lon)
+def _as_lat_lon(lat_lon: _LatLonType) -> LatLon:
+    return lat_lon if isinstance(lat_lon, LatLon) else LatLon(*lat_lon)
+
+
+def _graphical_page_url(lat_lon: LatLon) -> str:
     page_url_pattern = ('MapClick.php?w0=t&w3=sfcwind&w3u=1&w4=sky&w5=pop&w6=rh&w7=rain&w8=thunder&AheadHour=0'
                         '&Submit=Submit&FcstType=graphical&textField1={lat}&textField2={lon}&site=all&unit=0&dd=&bw=')
-    page_url = os.path.join(URL_BASE, page_url_pattern.format(lat=lat_lon.latitude, lon=lat_lon.longitude))
-    page = urlopen(page_url)
-    soup = BeautifulSoup(page, 'html.parser')
-    img_tags = soup.find_all('img')
-    filtered_tags = list(filter(_is_forecast_img_tag, img_tags))
+    return os.path.join(URL_BASE, page_url_pattern.format(lat=lat_lon.latitude, lon=lat_lon.longitude))
+
+
+def _text_page_url(lat_lon: LatLon) -> str:
+    page_url_pattern = 'MapClick.php?lat={lat}&lon={lon}&unit=0&lg=english&FcstType=text&TextType=1'
+    return os.path.join(URL_BASE, page_url_pattern.format(lat=lat_lon.latitude, lon=lat_lon.longitude))
+
+
+def get_forecast_plot_url(lat_lon: _LatLonType = DEFAULT_LAT_LON) -> str:
+    page_url = _graphical_page_url(_as_lat_lon(lat_lon))
+    page = cached_read(page_url, source='nws_forecast')
+    # Only build tree nodes for the meteogram <img>, not the whole page
+    with metrics.span('parse'):
+        soup = BeautifulSoup(page, HTML_PARSER, parse_only=SoupStrainer('img', src=_is_forecast_img_src))
+    filtered_tags = soup.find_all('img')
     if len(filtered_tags) == 0:
         raise RuntimeError(f'Could not find forecast image url at {page_url}')
     elif len(filtered_tags) > 1:
         raise RuntimeError(f'Multiple candidate forecast image urls at {page_url}')
-    img_url = URL_BASE + filtered_tags[0]['src']
-    now_str = datetime.now(tz=pytz.UTC).strftime('%Y%m%dT%H%M%S')
-    img_filename = IMG_FILENAME_TEMPLATE.format(lat=lat_lon.latitude, lon=lat_lon.longitude, ts=now_str)
-    img_path = os.path.join(CACHE_DIR, img_filename)
-    os.makedirs(os.path.dirname(img_path), exist_ok=True)
-    path, resp = urlretrieve(img_url, img_path)
+    return URL_BASE + filtered_tags[0]['src']
+
+
+def get_forecast_plot(lat_lon: _LatLonType = DEFAULT_LAT_LON) -> bytes:
+    # The meteogram is generated per request, so it goes straight from the response into memory
+    resp = get_transport().get(get_forecast_plot_url(lat_lon))
+    resp.raise_for_status()
+    return resp.content
+
+
+def save_forecast_plot(
+        lat_lon: _LatLonType = DEFAULT_LAT_LON, path: Optional[str] = None, image_output: Optional[ImageOutput] = None,
+) -> str:
+    # With image_output, the meteogram is re-encoded before it's written, and `path` gets the matching extension
+    if path is None:
+        if image_output is not None:
+            raise ValueError('Saving a re-encoded forecast plot needs a path')
+        return cached_retrieve(get_forecast_plot_url(lat_lon), source='nws_forecast')
+    data = get_forecast_plot(lat_lon)
+    if image_output is not None:
+        image = compact_image(data, image_output, name='nws_forecast')
+        data, path = image.data, image.filename(path)
+    with open(path, 'wb') as f:
+        f.write(data)
     return path
 
 
@@ -55,12 +91,9 @@ class ForecastText:
 
 
 def get_forecast_text(lat_lon: _LatLonType = DEFAULT_LAT_LON) -> ForecastText:
-    if not isinstance(lat_lon, LatLon):
-        lat_lon = LatLon(*lat_lon)
-    page_url_pattern = 'MapClick.php?lat={lat}&lon={lon}&unit=0&lg=english&FcstType=text&TextType=1'
-    page_url = os.path.join(URL_BASE, page_url_pattern.format(lat=lat_lon.latitude, lon=lat_lon.longitude))
-    page = urlopen(page_url)
-    soup = BeautifulSoup(page, 'html.parser')
+    page = cached_read(_text_page_url(_as_lat_lon(lat_lon)), source='nws_forecast')
+    with metrics.span('parse'):
+        soup = BeautifulSoup(page, HTML_PARSER, parse_only=SoupStrainer('table'))
     title_tag, forecast_tag = soup.find_all('table')
 
     title_parts = list(title_tag.stripped_strings)
@@ -77,25 +110,187 @@ def get_forecast_text(lat_lon: _LatLonType = DEFAULT_LAT_LON) -> ForecastText:
     return ForecastText(title_str, forecast_str)
 
 
+"""----------------------------------------------------------------------------
+api.weather.gov backend
+----------------------------------------------------------------------------"""
+
+
+@dataclass
+class GridPoint:
+    office: str
+    grid_x: int
+    grid_y: int
+    city: str
+    state: str
+
+    @property
+    def forecast_url(self) -> str:
+        return f'{API_URL_BASE}/gridpoints/{self.office}/{self.grid_x},{self.grid_y}/forecast'
+
+    @property
+    def forecast_hourly_url(self) -> str:
+        return f'{self.forecast_url}/hourly'
+
+
+@dataclass
+class HourlyForecast:
+    start_time: str  # ISO 8601 with the local UTC offset, as given by the API
+    temperature: Optional[float]
+    temperature_unit: str
+    wind_speed: str  # e.g. '5 to 10 mph'
+    wind_direction: str
+    precip_probability: Optional[float]  # Percent
+    short_forecast: str
+
+
+class GridPointResolver:
+    # LatLon -> NWS office and grid cell. The /points lookup practically never changes for a location, so its
+    # answers are kept on disk and the lookup costs a round trip only the first time a location is seen.
+
+    def __init__(self, path: str = GRID_POINTS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._points: Optional[Dict[str, GridPoint]] = None
+
+    @staticmethod
+    def _key(lat_lon: LatLon) -> str:
+        # The API itself rounds to 4 decimal places
+        return f'{lat_lon.latitude:.4f},{lat_lon.longitude:.4f}'
+
+    def _load(self) -> Dict[str, GridPoint]:
+        if self._points is None:
+            try:
+                with open(self.path) as f:
+                    self._points = {k: GridPoint(**v) for k, v in json.load(f).items()}
+            except FileNotFoundError:
+                self._points = {}
+        return self._points
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({k: asdict(v) for k, v in self._points.items()}, f)
+        os.replace(tmp_path, self.path)
+
+    def resolve(self, lat_lon: _LatLonType) -> GridPoint:
+        key = self._key(_as_lat_lon(lat_lon))
+        with self._lock:
+            point = self._load().get(key)
+        if point is not None:
+            return point
+        resp = get_transport().get(f'{API_URL_BASE}/points/{key}')
+        resp.raise_for_status()
+        props = resp.json()['properties']
+        location = props['relativeLocation']['properties']
+        point = GridPoint(office=props['gridId'], grid_x=props['gridX'], grid_y=props['gridY'],
+                          city=location['city'], state=location['state'])
+        with self._lock:
+            self._load()[key] = point
+            self._save()
+        return point
+
+
+default_resolver = GridPointResolver()
+
+
+def _get_api_periods(url: str) -> (dict, List[dict]):
+    props = json.loads(cached_read(url, source='nws_forecast'))['properties']
+    return props, props['periods']
+
+
+def get_api_forecast_text(lat_lon: _LatLonType = DEFAULT_LAT_LON, point: Optional[GridPoint] = None,
+                          num_periods: int = 2) -> ForecastText:
+    if point is None:
+        point = default_resolver.resolve(lat_lon)
+    props, periods = _get_api_periods(point.forecast_url)
+    title_str = f"{point.city} {point.state}, Last Update: {props.get('updateTime') or props.get('updated')}"
+    forecast_str = '\n\n'.join(f"{p['name']} {p['detailedForecast']}" for p in periods[:num_periods])
+    return ForecastText(title_str, forecast_str)
+
+
+def get_api_hourly_forecast(lat_lon: _LatLonType = DEFAULT_LAT_LON,
+                            point: Optional[GridPoint] = None) -> List[HourlyForecast]:
+    if point is None:
+        point = default_resolver.resolve(lat_lon)
+    _, periods = _get_api_periods(point.forecast_hourly_url)
+    return [HourlyForecast(start_time=p['startTime'],
+                           temperature=p.get('temperature'),
+                           temperature_unit=p.get('temperatureUnit', ''),
+                           wind_speed=p.get('windSpeed', ''),
+                           wind_direction=p.get('windDirection', ''),
+                           precip_probability=(p.get('probabilityOfPrecipitation') or {}).get('value'),
+                           short_forecast=p.get('shortForecast', ''))
+            for p in periods]
+
+
+"""----------------------------------------------------------------------------
+Combined forecast
+----------------------------------------------------------------------------"""
+
+BACKENDS = ('html', 'api')
+
+
+@dataclass
+class Forecast:
+    text: Optional[ForecastText] = None
+    plot_png: Optional[bytes] = None
+    hourly: Optional[List[HourlyForecast]] = None
+
+
+def get_forecast(lat_lon: _LatLonType = DEFAULT_LAT_LON, text=True, plot=True, hourly=False,
+                 backend='html') -> Forecast:
+    # The text (and hourly) requests and the graphical page (then its meteogram) are fetched side by side. The
+    # meteogram only exists as an image on forecast.weather.gov, so both backends get it from there.
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown forecast backend {backend!r}, expected one of {BACKENDS}')
+    point = default_resolver.resolve(lat_lon) if backend == 'api' and (text or hourly) else None
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix='nws-forecast') as executor:
+        if not text:
+            text_future = None
+        elif backend == 'api':
+            text_future = executor.submit(propagate_source(get_api_forecast_text), lat_lon, point)
+        else:
+            text_future = executor.submit(propagate_source(get_forecast_text), lat_lon)
+        hourly_future = executor.submit(propagate_source(get_api_hourly_forecast), lat_lon, point) if hourly else None
+        plot_future = executor.submit(propagate_source(get_forecast_plot), lat_lon) if plot else None
+        return Forecast(text=text_future.result() if text_future else None,
+                        plot_png=plot_future.result() if plot_future else None,
+                        hourly=hourly_future.result() if hourly_future else None)
+
 
-def post_forecast(channel: str, lat_lon: _LatLonType = DEFAULT_LAT_LON, text=True, plot=True, keep=False):
-    forecast_text = get_forecast_text(lat_lon) if text else None
-    img_path = save_forecast_plot(lat_lon) if plot else None
-    if not keep:
-        _cleanup_paths.append(img_path)
-    if forecast_text:
-        msg = f"*{forecast_text.title}*\n\n{forecast_text.forecast}"
+def render_forecast(
+        lat_lon: _LatLonType = DEFAULT_LAT_LON, text=True, plot=True, backend='html',
+        image_output: ImageOutput = DEFAULT_IMAGE_OUTPUT,
+) -> List[SlackPost]:
+    forecast = get_forecast(lat_lon, text=text, plot=plot, backend=backend)
+    if forecast.text:
+        msg = f"*{forecast.text.title}*\n\n{forecast.text.forecast}"
     else:
         msg = None
-    if img_path:
-        post_file(img_path, channel=channel, comment=msg)
-    elif msg:
-        post_message(msg, channel=channel)
+    lat_lon = _as_lat_lon(lat_lon)
+    dedup_key = f'forecast:{lat_lon.latitude},{lat_lon.longitude}'
+    if forecast.plot_png:
+        try:
+            image = compact_image(forecast.plot_png, image_output, name='nws_forecast')
+        except ImageBudgetError:
+            # The text forecast still goes out without the meteogram (counted as image_over_budget)
+            pass
+        else:
+            filename = f'nws_forecast_{lat_lon.latitude}_{lat_lon.longitude}{image.extension}'
+            return [SlackPost(text=msg, file=image.data, filename=filename, dedup_key=dedup_key)]
+    if msg:
+        return [SlackPost(text=msg, dedup_key=dedup_key)]
+    return []
 
 
-def _cleanup():
-    for path in _cleanup_paths:
-        os.remove(path)
+def post_forecast(
+        channel: str, lat_lon: _LatLonType = DEFAULT_LAT_LON, text=True, plot=True, backend='html',
+        dedup: bool | PostDedupStore = True, image_output: ImageOutput = DEFAULT_IMAGE_OUTPUT,
+):
+    dedup = resolve_dedup(dedup)
+    for post in render_forecast(lat_lon=lat_lon, text=text, plot=plot, backend=backend, image_output=image_output):
+        send_post(post, channel, dedup=dedup)
 
 
 """----------------------------------------------------------------------------
@@ -108,19 +303,24 @@ def parse_args():
     parser.add_argument('--channel', type=str, default=NykpSlackChannels.test_python_api)
     parser.add_argument('--lat', type=float, default=None)
     parser.add_argument('--lon', type=float, default=None)
-    parser.add_argument('--keep', action='store_true')
+    parser.add_argument('--backend', choices=BACKENDS, default='html',
+                        help='Scrape the forecast.weather.gov text page, or use the api.weather.gov JSON API')
+    parser.add_argument('--dedup', type=str2bool, default=True, help='Skip posts unchanged since the last run')
+    parser.add_argument('--webp', type=str2bool, default=None, help='Upload images as WebP instead of PNG')
+    parser.add_argument('--max-image-kb', type=float, default=None, help='Byte budget for each uploaded image')
     return parser
 
 
 def main(args):
     if args.lat and not args.lon or args.lon and not args.lat:
         raise ValueError(f'Both latitude and longitude required if not using default location')
+    image_output = DEFAULT_IMAGE_OUTPUT.with_overrides(webp=args.webp, max_kb=args.max_image_kb)
     if args.lat and args.lon:
         lat_lon = LatLon(latitude=args.lat, longitude=args.lon)
-        post_forecast(args.channel, lat_lon=lat_lon, keep=args.keep)
+        post_forecast(args.channel, lat_lon=lat_lon, backend=args.backend, dedup=args.dedup,
+                      image_output=image_output)
     else:
-        post_forecast(args.channel, keep=args.keep)
-    _cleanup()
+        post_forecast(args.channel, backend=args.backend, dedup=args.dedup, image_output=image_output)
 
 
 if __name__ == '__main__':
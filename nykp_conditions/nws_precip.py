@@ -1,40 +1,164 @@
 import json
-import os
-from dataclasses import dataclass
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Tuple, Union
+from typing import Iterator, List, Optional, Sequence, Union
 
 import numpy as np
 import pandas as pd
 import pendulum
 import pytz
-import urllib
+
+from utils.http_cache import cached_read
+from utils.metrics import propagate_source, timed
+from utils.scripts import try_main
+from utils.slack import NykpSlackChannels, SlackPost, send_post
+from utils.units import mm_to_inches
 
 DEFAULT_STATION = 'KNYC'
 DEFAULT_TIMEZONE = 'America/New_York'
 DATETIME_FMT = '%Y-%m-%dT%H:%M:%SZ'
-CACHE_DIR = 'cache'
-
-
-def _get_observations_url(station: str, start_dt: datetime, end_dt: datetime) -> str:
-    start = start_dt.astimezone(pytz.UTC).strftime(DATETIME_FMT)
-    end = end_dt.astimezone(pytz.UTC).strftime(DATETIME_FMT)
-    return 'https://api.weather.gov/stations/{station}/observations?start={start}&end={end}'
-
-
-def _get_ts_precip(observation: dict) -> Tuple[str, float]:
-    ts = observation['timestamp']
-    precip_mm = observation['precipitationLastHour']['value']
-    return (ts, precip_mm)
-
+OBSERVATIONS_URL_BASE = 'https://api.weather.gov/stations'
+OBSERVATION_HISTORY_URL_TEMPLATE = 'https://forecast.weather.gov/data/obhistory/{station}.html'
 
-def _get_hourly_precips(precip_series: pd.Series) -> pd.Series:
-    pass
+# Routine METARs go out a few minutes before the hour (:51 at KNYC), and a report's "last hour" precip covers the
+# time since the previous routine report. SPECI reports in between carry the accumulation so far in that hour.
+METAR_ROUTINE_MINUTE = 51
+TOTAL_WINDOWS_HOURS = (1, 6, 24, 72)
+DEFAULT_MAX_IN_FLIGHT = 4
 
 
-def _get_6_hour_precips(precip_series: pd.Series) -> pd.Series:
-    pass
-    
+def _get_observations_url(station: str, start_dt: datetime, end_dt: Optional[datetime] = None) -> str:
+    start = start_dt.astimezone(pytz.UTC).strftime(DATETIME_FMT)
+    url = f'{OBSERVATIONS_URL_BASE}/{station}/observations?start={start}'
+    if end_dt is not None:
+        url += f'&end={end_dt.astimezone(pytz.UTC).strftime(DATETIME_FMT)}'
+    return url
+
+
+def _iter_observation_pages(url: str, source: str) -> Iterator[List[dict]]:
+    # Follows the API's pagination links until a page comes back empty
+    seen_urls = set()
+    while url is not None and url not in seen_urls:
+        seen_urls.add(url)
+        page = json.loads(cached_read(url, source=source))
+        features = page.get('features', [])
+        if not features:
+            return
+        yield [feature['properties'] for feature in features]
+        url = (page.get('pagination') or {}).get('next')
+
+
+def _day_observations(station: str, day: datetime, now: datetime) -> List[dict]:
+    # Observations for one UTC day. Finished days have a fixed URL and are cached for long; the current day is
+    # requested without an end, so its URL also stays the same across runs and it refreshes on the short TTL.
+    day_end = day + timedelta(days=1)
+    if day_end <= now:
+        url, source = _get_observations_url(station, day, day_end), 'nws_precip_history'
+    else:
+        url, source = _get_observations_url(station, day), 'nws_precip'
+    return [obs for page in _iter_observation_pages(url, source) for obs in page]
+
+
+def iter_observations(
+        station: str, start_dt: datetime, end_dt: datetime, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+) -> Iterator[dict]:
+    # Observation properties for every UTC day touching [start_dt, end_dt], fetched in parallel but yielded a day
+    # at a time in order. Reports near the window edges and day boundaries can repeat; see observations_frame.
+    start_utc = start_dt.astimezone(pytz.UTC)
+    now = datetime.now(tz=pytz.UTC)
+    first_day = start_utc.replace(hour=0, minute=0, second=0, microsecond=0)
+    num_days = (end_dt.astimezone(pytz.UTC) - first_day).days + 1
+    days = [first_day + timedelta(days=i) for i in range(num_days)]
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for observations in executor.map(propagate_source(lambda d: _day_observations(station, d, now)), days):
+            yield from observations
+
+
+def _value(observation: dict, field: str) -> Optional[float]:
+    return (observation.get(field) or {}).get('value')
+
+
+@timed('parse')
+def observations_frame(observations: Sequence[dict]) -> pd.DataFrame:
+    # One row per report time (UTC), with the last hour's precip in mm; null means nothing was reported
+    timestamps = [obs['timestamp'] for obs in observations]
+    data = {
+        'last_hour': [_value(obs, 'precipitationLastHour') for obs in observations],
+    }
+    index = pd.DatetimeIndex(pd.to_datetime(timestamps, utc=True), name='timestamp')
+    df = pd.DataFrame(data, index=index, dtype='float64').sort_index()
+    # Corrected reports reuse the original's timestamp; keep the later one
+    return df[~df.index.duplicated(keep='last')]
+
+
+def _metar_hours(index: pd.DatetimeIndex) -> pd.DatetimeIndex:
+    # The top of the hour each report's "last hour" period ends at, e.g. 10:20 and 10:51 -> 11:00, 10:55 -> 12:00
+    return (index + pd.Timedelta(minutes=60 - METAR_ROUTINE_MINUTE)).ceil('h')
+
+
+def _get_hourly_precips(
+        observations: pd.DataFrame, start: Optional[pd.Timestamp] = None, end: Optional[pd.Timestamp] = None,
+) -> pd.Series:
+    # Precip (mm) per METAR hour. Within an hour the accumulation only grows, so the largest report (normally the
+    # routine one) is the hour's total and any SPECIs before it aren't counted twice. An hour with reports but no
+    # precip group was dry; an hour with no reports at all (from the first to the last, or start to end) is NaN.
+    last_hour = observations['last_hour']
+    hourly = last_hour.groupby(_metar_hours(observations.index)).max().fillna(0.0)
+    first = hourly.index[0] if start is None and len(hourly) else start
+    last = hourly.index[-1] if end is None and len(hourly) else end
+    if first is None or last is None:
+        return hourly
+    full_index = pd.date_range(first, last, freq='h', name='hour')
+    return hourly.reindex(full_index)
+
+
+def rolling_totals(hourly: pd.Series, windows: Sequence[int] = TOTAL_WINDOWS_HOURS) -> (pd.DataFrame, pd.DataFrame):
+    # Trailing totals ending at each hour, from differences of one cumulative sum rather than a rolling sum per
+    # window, and alongside them how many of each window's hours had no report (a cumulative count of the NaNs,
+    # with hours before the start of the data also counted). A total with missing hours is only a lower bound.
+    values = hourly.to_numpy(dtype='float64')
+    missing = np.isnan(values)
+    cumulative = np.concatenate([[0.0], np.cumsum(np.where(missing, 0.0, values))])
+    cumulative_missing = np.concatenate([[0], np.cumsum(missing)])
+    positions = np.arange(1, len(cumulative))
+    totals, missing_hours = {}, {}
+    for hours in windows:
+        window_start = np.maximum(positions - hours, 0)
+        totals[f'{hours}h'] = cumulative[positions] - cumulative[window_start]
+        missing_hours[f'{hours}h'] = (cumulative_missing[positions] - cumulative_missing[window_start]
+                                      + np.maximum(hours - positions, 0))
+    return pd.DataFrame(totals, index=hourly.index), pd.DataFrame(missing_hours, index=hourly.index)
+
+
+def get_precip_totals(
+        station: str = DEFAULT_STATION,
+        as_of: Optional[datetime] = None,
+        windows: Sequence[int] = TOTAL_WINDOWS_HOURS,
+        history_hours: int = 0,
+) -> (pd.DataFrame, pd.DataFrame):
+    # Trailing precip totals (mm) for each window, at every hour from `history_hours` before as_of up to it, and the
+    # number of hours in each window with no observations
+    as_of = datetime.now(tz=pytz.UTC) if as_of is None else as_of
+    start_dt = as_of - timedelta(hours=max(windows) + history_hours)
+    observations = observations_frame(list(iter_observations(station, start_dt, as_of)))
+    as_of_utc = pd.Timestamp(as_of).tz_convert('UTC')
+    observations = observations[(observations.index > pd.Timestamp(start_dt).tz_convert('UTC'))
+                                & (observations.index <= as_of_utc)]
+    if len(observations) == 0:
+        return _empty_totals(windows), _empty_totals(windows)
+    # Every METAR hour the windows cover, up to the last one whose routine report is out rather than the one still in
+    # progress, so hours with no reports at all count as missing instead of dry
+    last_hour = (as_of_utc + pd.Timedelta(minutes=60 - METAR_ROUTINE_MINUTE)).floor('h')
+    first_hour = last_hour - pd.Timedelta(hours=max(windows) + history_hours - 1)
+    hourly = _get_hourly_precips(observations, start=first_hour, end=last_hour)
+    totals, missing = rolling_totals(hourly, windows=windows)
+    return totals.iloc[-(history_hours + 1):], missing.iloc[-(history_hours + 1):]
+
+
+def _empty_totals(windows: Sequence[int]) -> pd.DataFrame:
+    return pd.DataFrame({f'{hours}h': pd.Series(dtype='float64') for hours in windows},
+                        index=pd.DatetimeIndex([], tz='UTC', name='hour'))
 
 
 def get_observed_precip(
@@ -42,46 +166,63 @@ def get_observed_precip(
         as_of: Optional[datetime] = None,
         hours: int = 24,
         tz: Union[str, timezone] = DEFAULT_TIMEZONE,
-        clean_up=True,
 ) -> float:
+    # Total precip (mm) over the `hours` up to as_of, counting hours with no observations as dry
     if isinstance(tz, str):
         tz = pytz.timezone(tz)
 
     if as_of is None:
-        as_of = datetime.now(tz=pytz.timezone(tz))
+        as_of = datetime.now(tz=tz)
     elif isinstance(as_of, str):
-        as_of = pendulum.parse(as_of)
-
-    start_dt = as_of - timedelta(hours=hours)
-    filename_dt_fmt = '%Y%m%dT%H%M%S'
-    tmp_filename = f'{station}_observations_{start_dt.strftime(filename_dt_fmt)}_{as_of.strftime(filename_dt_fmt)}.json'
-    
-    tmp_dir = CACHE_DIR
-    tmp_path = os.path.join(tmp_dir, tmp_filename)
-    clean_up_paths = []
-    if clean_up:
-        clean_up_paths.append(tmp_filename)
-    
-    if not os.path.exists(tmp_dir):
-        os.makedirs(os.path.dirname(tmp_path))
-        if clean_up:
-            clean_up_paths.append(tmp_dir)
-    
-    url = _get_observations_url(station, start_dt, as_of)
-    resp = urllib.request.urlretrieve(url, tmp_path)
-    with open(tmp_path) as f:
-        retrieved_json = json.load(tmp_path)
-
-    for path in clean_up_paths:
-        if os.path.isdir(path):
-            os.rmdir(path)
-        else:
-            os.remove(path)
-    
-    observations = [feature['properties'] for feature in retrieved_json['features']]
-    t, precip_mm = zip(*map(_get_ts_precip, observations))
-    precip_mm_series = pd.Series(data=precip_mm, index=pd.to_datetime(t)).sort_index()
-
-
-def post_observed_precip(channel: str):
-    pass
+        as_of = pendulum.parse(as_of, tz=tz)
+
+    totals, _ = get_precip_totals(station, as_of=as_of, windows=(hours,))
+    return float(totals.iloc[-1, 0]) if len(totals) else 0.0
+
+
+def render_observed_precip(
+        station: str = DEFAULT_STATION,
+        windows: Sequence[int] = TOTAL_WINDOWS_HOURS,
+        tz: Union[str, timezone] = DEFAULT_TIMEZONE,
+) -> List[SlackPost]:
+    totals, missing = get_precip_totals(station, windows=windows)
+    if len(totals) == 0:
+        return [SlackPost(text=f'No precipitation observations from {station} in the last {max(windows)} hours')]
+    latest, latest_missing = totals.iloc[-1], missing.iloc[-1]
+    as_of = totals.index[-1].tz_convert(tz)
+    # %-I (no leading zero) is glibc-only
+    as_of = f"{as_of.strftime('%a %m/%d')} {as_of.strftime('%I:%M %p').lstrip('0')}"
+    history_url = OBSERVATION_HISTORY_URL_TEMPLATE.format(station=station)
+    lines = [f'*<{history_url}|Observed precipitation at {station}>* as of {as_of}']
+    for name, mm in latest.items():
+        line = f'Last {name}: {mm_to_inches(mm):.2f} in'
+        if latest_missing[name]:
+            line += f' (incomplete: no reports for {int(latest_missing[name])} h)'
+        lines.append(line)
+    return [SlackPost(text='\n'.join(lines), dedup_key=f'precip:{station}')]
+
+
+def post_observed_precip(channel: str, station: str = DEFAULT_STATION):
+    for post in render_observed_precip(station=station):
+        send_post(post, channel)
+
+
+"""----------------------------------------------------------------------------
+SCRIPT CODE
+----------------------------------------------------------------------------"""
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('--channel', type=str, default=NykpSlackChannels.test_python_api)
+    parser.add_argument('--station', type=str, default=DEFAULT_STATION)
+    return parser
+
+
+def main(args):
+    post_observed_precip(args.channel, station=args.station)
+
+
+if __name__ == '__main__':
+    parser = parse_args()
+    try_main(main, parser)
@@ -0,0 +1,196 @@
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import pendulum
+
+from currents_query import LOCAL_TIMEZONE, CurrentsIndex
+from noaa_currents import Station
+from utils.scripts import try_main
+
+DEFAULT_SPEED_KNOTS = 3.0
+DEFAULT_STEP_MINUTES = 5
+DEFAULT_TOP_N = 5
+DEFAULT_MIN_SEPARATION_MINUTES = 60
+INTEGRATION_STEP_SECONDS = 60
+MIN_GROUND_SPEED_KNOTS = 0.25  # Floor for legs into a current stronger than the paddler
+TIMING_REFINEMENTS = 3  # Passes to settle each leg's duration against the drift it gets
+SECONDS_PER_HOUR = 3600.0
+
+
+@dataclass
+class Leg:
+    station: Station  # Where the current for this leg is predicted
+    distance_nm: float
+    direction: int = 1  # 1 if the leg runs the way the flood does at the station, -1 if it runs with the ebb
+
+
+@dataclass
+class PaddlingWindow:
+    launch: pd.Timestamp
+    finish: pd.Timestamp
+    drift_nm: float  # Distance the current carries you along the route; negative means it's against you
+    leg_drift_nm: Tuple[float, ...]
+
+
+class _CurrentIntegrals:
+    # Running integral of each station's current (knot-hours = nautical miles) on a fine grid, so the drift over any
+    # interval is a difference of two interpolated values. Stretches with no prediction are tracked the same way, so
+    # intervals touching them can be thrown out.
+
+    def __init__(self, index: CurrentsIndex, stations: Sequence[str], start: float, end: float):
+        self.grid = np.arange(start, end + INTEGRATION_STEP_SECONDS, INTEGRATION_STEP_SECONDS, dtype='float64')
+        knots = index.knots_at_epoch(self.grid, stations=stations)
+        missing = np.isnan(knots)
+        knots = np.where(missing, 0.0, knots)
+        step_hours = INTEGRATION_STEP_SECONDS / SECONDS_PER_HOUR
+        trapezoids = (knots[:, 1:] + knots[:, :-1]) / 2 * step_hours
+        zeros = np.zeros((len(stations), 1))
+        self.nm = np.concatenate([zeros, np.cumsum(trapezoids, axis=1)], axis=1)
+        self.missing = np.concatenate([zeros, np.cumsum(missing[:, 1:] | missing[:, :-1], axis=1)], axis=1)
+        self.row = {station_id: i for i, station_id in enumerate(stations)}
+
+    def drift(self, station_id: str, t0: np.ndarray, t1: np.ndarray) -> np.ndarray:
+        # Nautical miles of flood-positive drift between t0 and t1; NaN where predictions are missing
+        row = self.row[station_id]
+        nm = np.interp(t1, self.grid, self.nm[row]) - np.interp(t0, self.grid, self.nm[row])
+        gaps = np.interp(t1, self.grid, self.missing[row]) - np.interp(t0, self.grid, self.missing[row])
+        outside = (t0 < self.grid[0]) | (t1 > self.grid[-1])
+        return np.where((gaps > 0) | outside, np.nan, nm)
+
+
+def evaluate_launches(
+        legs: Sequence[Leg], launches: np.ndarray, integrals: _CurrentIntegrals, speed_knots: float,
+) -> (np.ndarray, np.ndarray):
+    # For launch times (Unix seconds), the finish times and each leg's drift (legs x launches). Every launch is
+    # evaluated at once; only the legs are a loop, since each starts when the one before it ends.
+    t = launches.astype('float64')
+    leg_drifts = []
+    for leg in legs:
+        hours = np.full(len(t), leg.distance_nm / speed_knots)
+        for _ in range(TIMING_REFINEMENTS):
+            drift = leg.direction * integrals.drift(leg.station.id, t, t + hours * SECONDS_PER_HOUR)
+            ground_speed = np.maximum(speed_knots + drift / hours, MIN_GROUND_SPEED_KNOTS)
+            hours = leg.distance_nm / np.where(np.isnan(ground_speed), speed_knots, ground_speed)
+        leg_drifts.append(leg.direction * integrals.drift(leg.station.id, t, t + hours * SECONDS_PER_HOUR))
+        t = t + hours * SECONDS_PER_HOUR
+    return t, np.array(leg_drifts)
+
+
+def _top_separated(scores: np.ndarray, launches: np.ndarray, top_n: int, min_separation: float) -> List[int]:
+    # Best launches first, skipping any within min_separation seconds of one already picked
+    picked = []
+    for i in np.argsort(-scores, kind='stable'):
+        if np.isnan(scores[i]):
+            break
+        if all(abs(launches[i] - launches[j]) >= min_separation for j in picked):
+            picked.append(i)
+            if len(picked) == top_n:
+                break
+    return picked
+
+
+def _as_local(t) -> pendulum.DateTime:
+    if isinstance(t, str):
+        return pendulum.parse(t, tz=LOCAL_TIMEZONE)
+    return pendulum.instance(t, tz=LOCAL_TIMEZONE) if not isinstance(t, pendulum.DateTime) else t
+
+
+def plan_windows(
+        legs: Sequence[Leg],
+        start,
+        end,
+        speed_knots: float = DEFAULT_SPEED_KNOTS,
+        step_minutes: int = DEFAULT_STEP_MINUTES,
+        top_n: int = DEFAULT_TOP_N,
+        min_separation_minutes: float = DEFAULT_MIN_SEPARATION_MINUTES,
+        earliest: Optional[str] = None,
+        latest: Optional[str] = None,
+        index: Optional[CurrentsIndex] = None,
+) -> List[PaddlingWindow]:
+    # Scores every launch between start and end (every step_minutes, optionally only between the local times of day
+    # earliest and latest, e.g. '06:00') by total drift along the route, and returns the best top_n
+    start, end = _as_local(start), _as_local(end)
+    stations = list(dict.fromkeys(leg.station.id for leg in legs))
+    # Long enough to finish the route even crawling against the current the whole way
+    max_route_hours = sum(leg.distance_nm for leg in legs) / MIN_GROUND_SPEED_KNOTS
+    horizon = end.add(hours=int(np.ceil(max_route_hours)))
+    if index is None:
+        unique_stations = list({leg.station.id: leg.station for leg in legs}.values())
+        index = CurrentsIndex.fetch(unique_stations, start=start.subtract(days=1), end=horizon)
+
+    launches = np.arange(start.int_timestamp, end.int_timestamp + 1, step_minutes * 60, dtype='int64')
+    if earliest is not None or latest is not None:
+        local = pd.DatetimeIndex(launches.astype('datetime64[s]')).tz_localize('UTC').tz_convert(LOCAL_TIMEZONE)
+        minutes = local.hour * 60 + local.minute
+        keep = np.ones(len(launches), dtype=bool)
+        if earliest is not None:
+            keep &= minutes >= _minutes(earliest)
+        if latest is not None:
+            keep &= minutes <= _minutes(latest)
+        launches = launches[keep]
+    if len(launches) == 0:
+        return []
+
+    integrals = _CurrentIntegrals(index, stations, float(launches[0]), float(horizon.int_timestamp))
+    finishes, leg_drifts = evaluate_launches(legs, launches, integrals, speed_knots)
+    totals = leg_drifts.sum(axis=0)
+    picked = _top_separated(totals, launches, top_n, min_separation_minutes * 60)
+
+    def to_local(t):
+        return pd.Timestamp(int(round(t)), unit='s', tz='UTC').tz_convert(LOCAL_TIMEZONE)
+
+    return [PaddlingWindow(launch=to_local(launches[i]), finish=to_local(finishes[i]), drift_nm=float(totals[i]),
+                           leg_drift_nm=tuple(float(d) for d in leg_drifts[:, i]))
+            for i in picked]
+
+
+def _minutes(hh_mm: str) -> int:
+    hour, minute = map(int, hh_mm.split(':'))
+    return hour * 60 + minute
+
+
+"""----------------------------------------------------------------------------
+SCRIPT CODE
+----------------------------------------------------------------------------"""
+
+
+def _parse_leg(spec: str) -> Leg:
+    # STATION_ID:DISTANCE_NM, plus :-1 for a leg that runs with the ebb
+    parts = spec.split(':')
+    if len(parts) not in (2, 3):
+        raise ValueError(f'Expected STATION_ID:DISTANCE_NM[:DIRECTION], got {spec!r}')
+    direction = int(parts[2]) if len(parts) == 3 else 1
+    return Leg(Station(parts[0], parts[0]), float(parts[1]), direction)
+
+
+def parse_args():
+    parser = ArgumentParser(description='Find the launch times with the most favorable current along a route')
+    parser.add_argument('--leg', action='append', required=True, metavar='STATION_ID:DISTANCE_NM[:DIRECTION]',
+                        help='A route leg, in order; DIRECTION is 1 (with the flood, default) or -1 (with the ebb)')
+    parser.add_argument('--start', type=str, default=None, help='First launch (default: now)')
+    parser.add_argument('--end', type=str, default=None, help='Last launch (default: a week after start)')
+    parser.add_argument('--speed', type=float, default=DEFAULT_SPEED_KNOTS, help='Paddling speed in knots')
+    parser.add_argument('--step', type=int, default=DEFAULT_STEP_MINUTES, help='Minutes between candidate launches')
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP_N)
+    parser.add_argument('--earliest', type=str, default=None, help='Earliest local launch time of day, e.g. 06:00')
+    parser.add_argument('--latest', type=str, default=None, help='Latest local launch time of day, e.g. 18:00')
+    return parser
+
+
+def main(args):
+    start = pendulum.now(LOCAL_TIMEZONE) if args.start is None else _as_local(args.start)
+    end = start.add(weeks=1) if args.end is None else _as_local(args.end)
+    windows = plan_windows([_parse_leg(spec) for spec in args.leg], start, end, speed_knots=args.speed,
+                           step_minutes=args.step, top_n=args.top, earliest=args.earliest, latest=args.latest)
+    for w in windows:
+        legs = ', '.join(f'{d:+.2f}' for d in w.leg_drift_nm)
+        print(f"{w.launch.strftime('%a %m/%d %I:%M %p')} -> {w.finish.strftime('%I:%M %p')}  "
+              f"drift {w.drift_nm:+.2f} nm  (legs: {legs})")
+
+
+if __name__ == '__main__':
+    parser = parse_args()
+    try_main(main, parser)
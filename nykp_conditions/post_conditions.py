@@ -1,21 +1,20 @@
+import threading
+import time
 from argparse import ArgumentParser
+from concurrent.futures import Future, TimeoutError
+from typing import Callable, Dict, List, Optional
 
-from noaa_currents import post_currents
-from notify_nyc import post_waterbody_advisories
-from nws_forecast import post_forecast
-from nws_precip import post_observed_precip
+from sources import SOURCES
+from utils.metrics import source_context
+from utils.post_dedup import PostDedupStore
 from utils.scripts import str2bool, try_main
-from utils.slack import NykpSlackChannels
-from water_temps import post_water_temps
+from utils.slack import NykpSlackChannels, SlackPost, SlackPostQueue
 
 
-default_config = {
-    'currents': True,
-    'advisories': True,
-    'precip': True,
-    'water-temp': True,
-    'forecast': True,
-}
+default_config = {name: source.default_enabled for name, source in SOURCES.items()}
+
+# Seconds each source gets to fetch and render, measured from the start of the run
+default_deadlines = {name: source.deadline for name, source in SOURCES.items()}
 
 
 def _add_config_fields(parser: ArgumentParser):
@@ -29,25 +28,101 @@ def parse_args() -> ArgumentParser:
     parser = ArgumentParser()
     parser.add_argument('--channel', type=str, default=None)
     parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--concurrent', type=str2bool, default=False,
+                        help='Fetch and render all sources in parallel before posting (default: False)')
+    parser.add_argument('--deadline', type=float, default=None,
+                        help='Override the per-source deadline in seconds for concurrent mode')
+    parser.add_argument('--dedup', type=str2bool, default=True,
+                        help='Skip posts whose content is unchanged since the last run (default: True)')
+    parser.add_argument('--edit-changed', type=str2bool, default=False,
+                        help='With --dedup, edit the previous message in place when its content changed')
     parser = _add_config_fields(parser)
     return parser
 
 
+def _enabled_renderers(args) -> Dict[str, Callable[[], List[SlackPost]]]:
+    # Only the enabled sources' modules ever get imported
+    return {name: source.renderer(days=args.days)
+            for name, source in SOURCES.items() if getattr(args, source.arg_name)}
+
+
+def post_serially(channel: str, renderers: Dict[str, Callable[[], List[SlackPost]]],
+                  dedup: Optional[PostDedupStore] = None):
+    with SlackPostQueue(dedup=dedup) as post_queue:
+        for name, render in renderers.items():
+            posts = render()
+            with source_context(name):
+                futures = [post_queue.submit(post, channel) for post in posts]
+            for f in futures:
+                f.result()
+
+
+def _start_render(name: str, render: Callable[[], List[SlackPost]]) -> Future:
+    # On a daemon thread rather than a ThreadPoolExecutor worker, since those are joined at exit: a render that hangs
+    # past its deadline is abandoned and doesn't keep the process alive
+    future = Future()
+
+    def run():
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(render())
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name=f'render-{name}', daemon=True).start()
+    return future
+
+
+def post_concurrently(channel: str, renderers: Dict[str, Callable[[], List[SlackPost]]], deadlines=None,
+                      dedup: Optional[PostDedupStore] = None):
+    # Render in parallel, post in the order of `renderers`; failed or late sources are reported as missing
+    if deadlines is None:
+        deadlines = default_deadlines
+    start = time.monotonic()
+    futures = {name: _start_render(name, f) for name, f in renderers.items()}
+    post_queue = SlackPostQueue(dedup=dedup)
+    sent = []
+    missing = {}
+    try:
+        for name, future in futures.items():
+            remaining = deadlines.get(name, max(deadlines.values())) - (time.monotonic() - start)
+            try:
+                posts = future.result(timeout=max(remaining, 0))
+            except TimeoutError:
+                missing[name] = 'timed out'
+                continue
+            except Exception as e:
+                missing[name] = f'{type(e).__name__}: {e}'
+                continue
+            # The queue keeps these in order while later sources are still being waited on
+            with source_context(name):
+                sent += [post_queue.submit(post, channel) for post in posts]
+        if missing:
+            # Not deduplicated: a source that keeps failing should be reported on every run
+            lines = [f'• {name}: {reason}' for name, reason in missing.items()]
+            notice = SlackPost(text='_Missing sources:_\n' + '\n'.join(lines))
+            sent.append(post_queue.submit(notice, channel, dedup=False))
+    finally:
+        post_queue.close()
+    for f in sent:
+        f.result()  # Raise any posting errors
+    return missing
+
+
 def main(args):
     if args.channel is not None:
         channel = args.channel
     else:
         channel = NykpSlackChannels.test_python_api
-    if args.currents:
-        post_currents(channel, days=args.days)
-    if args.advisories:
-        post_waterbody_advisories(channel, days=args.days)
-    if args.precip:
-        post_observed_precip(channel)
-    if args.water_temp:
-        post_water_temps(channel)
-    if args.forecast:
-        post_forecast(channel)
+    renderers = _enabled_renderers(args)
+    dedup = PostDedupStore(edit_changed=args.edit_changed) if args.dedup else None
+    if args.concurrent:
+        deadlines = default_deadlines
+        if args.deadline is not None:
+            deadlines = {name: args.deadline for name in default_deadlines}
+        post_concurrently(channel, renderers, deadlines=deadlines, dedup=dedup)
+    else:
+        post_serially(channel, renderers, dedup=dedup)
 
 
 if __name__ == '__main__':
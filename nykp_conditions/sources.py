@@ -0,0 +1,99 @@
+import importlib
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional
+
+from utils.metrics import metrics, source_context
+from utils.scripts import try_main
+from utils.slack import SlackPost
+
+SOURCES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@dataclass(frozen=True)
+class SourceDescriptor:
+    # Everything post_conditions needs to know about a source without importing it. The module (and its pandas,
+    # matplotlib, bs4, feedparser, ... imports) is only loaded when the source is actually run.
+    name: str
+    module: str
+    render: str  # Name of a function in `module` returning List[SlackPost]
+    deadline: float  # Seconds to fetch and render in concurrent mode
+    default_enabled: bool = True
+    takes_days: bool = False
+
+    @property
+    def arg_name(self) -> str:
+        return self.name.replace('-', '_')
+
+    def load(self) -> Callable[..., List[SlackPost]]:
+        return getattr(importlib.import_module(self.module), self.render)
+
+    def renderer(self, days: int = 1) -> Callable[[], List[SlackPost]]:
+        # Defers the import to the first call, so it happens on whichever thread runs the source
+        def _render():
+            with source_context(self.name), metrics.span('render_source'):
+                render = self.load()
+                return render(days=days) if self.takes_days else render()
+        return _render
+
+
+SOURCES: Dict[str, SourceDescriptor] = {}
+
+
+def register_source(descriptor: SourceDescriptor) -> SourceDescriptor:
+    SOURCES[descriptor.name] = descriptor
+    return descriptor
+
+
+register_source(SourceDescriptor('currents', 'noaa_currents', 'render_currents', deadline=30, takes_days=True))
+register_source(SourceDescriptor('advisories', 'notify_nyc', 'render_waterbody_advisories', deadline=20,
+                                 takes_days=True))
+register_source(SourceDescriptor('precip', 'nws_precip', 'render_observed_precip', deadline=30))
+register_source(SourceDescriptor('water-temp', 'water_temps', 'render_water_temps', deadline=60))
+register_source(SourceDescriptor('forecast', 'nws_forecast', 'render_forecast', deadline=45))
+
+
+def benchmark_imports(names: Optional[Iterable[str]] = None, repeat: int = 3) -> Dict[str, float]:
+    # Best-of-`repeat` cold import time in seconds for each source, each in a fresh interpreter
+    if names is None:
+        names = list(SOURCES)
+    code = 'import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)'
+    timings = {}
+    for name in names:
+        module = SOURCES[name].module
+        runs = []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, '-c', code.format(module=module)], cwd=SOURCES_DIR,
+                                 capture_output=True, text=True, check=True)
+            runs.append(float(out.stdout.strip()))
+        timings[name] = min(runs)
+    return timings
+
+
+"""----------------------------------------------------------------------------
+SCRIPT CODE
+----------------------------------------------------------------------------"""
+
+
+def parse_args():
+    parser = ArgumentParser(description='Benchmark the startup (import) time of each condition source')
+    parser.add_argument('sources', nargs='*', help=f"Any of: {', '.join(SOURCES)} (default: all)")
+    parser.add_argument('--repeat', type=int, default=3)
+    return parser
+
+
+def main(args):
+    unknown = set(args.sources) - set(SOURCES)
+    if unknown:
+        raise ValueError(f"Unknown sources: {', '.join(sorted(unknown))}")
+    timings = benchmark_imports(args.sources or None, repeat=args.repeat)
+    for name, seconds in timings.items():
+        print(f'{name:<12} {SOURCES[name].module:<15} {1000 * seconds:8.1f} ms')
+
+
+if __name__ == '__main__':
+    parser = parse_args()
+    try_main(main, parser)
@@ -0,0 +1,78 @@
+import os
+import threading
+from typing import Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows; appends there are only serialized within a process
+    fcntl = None
+
+ARCHIVE_DIR = os.path.abspath(os.path.join(__file__, '../../../archive'))
+TIME_FIELD = 't'
+
+# One lock per archive file, shared by every MemmapArchive on that path in this process
+_path_locks = {}
+_path_locks_lock = threading.Lock()
+
+
+def _path_lock(path: str) -> threading.Lock:
+    with _path_locks_lock:
+        return _path_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+class MemmapArchive:
+    # Append-only file of fixed-size records sorted by a datetime64 't' field. Reads memory-map the file and
+    # binary search the time range, so only the pages that are touched get loaded.
+
+    def __init__(self, path: str, dtype: np.dtype):
+        if TIME_FIELD not in dtype.names:
+            raise ValueError(f"Archive dtype needs a '{TIME_FIELD}' field: {dtype}")
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self._lock = _path_lock(path)
+
+    def __len__(self) -> int:
+        try:
+            return os.path.getsize(self.path) // self.dtype.itemsize
+        except FileNotFoundError:
+            return 0
+
+    def records(self) -> np.ndarray:
+        n = len(self)
+        if n == 0:
+            return np.empty(0, dtype=self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode='r', shape=(n,))
+
+    @property
+    def last_time(self) -> Optional[np.datetime64]:
+        records = self.records()
+        return records[TIME_FIELD][-1] if len(records) else None
+
+    def read(self, start: Optional[np.datetime64] = None, end: Optional[np.datetime64] = None) -> np.ndarray:
+        # Records with start <= t < end
+        records = self.records()
+        times = records[TIME_FIELD]
+        lo = 0 if start is None else np.searchsorted(times, np.datetime64(start), side='left')
+        hi = len(records) if end is None else np.searchsorted(times, np.datetime64(end), side='left')
+        return records[lo:hi]
+
+    def append(self, new_records: np.ndarray) -> int:
+        # Only records newer than what's stored are written, so overlapping fetch windows are harmless. The thread
+        # lock covers other archives on the same path in this process, and flock other processes (e.g. the daemon
+        # and a one-off script), so the last time checked is still the last one when the write lands.
+        new_records = np.sort(np.asarray(new_records, dtype=self.dtype), order=TIME_FIELD)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock, open(self.path, 'ab') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            last = self.last_time
+            if last is not None:
+                new_records = new_records[new_records[TIME_FIELD] > last]
+            if len(new_records) == 0:
+                return 0
+            _, unique_idx = np.unique(new_records[TIME_FIELD], return_index=True)
+            new_records = new_records[unique_idx]
+            f.write(new_records.tobytes())
+            return len(new_records)
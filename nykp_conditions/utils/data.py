@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 
@@ -9,3 +10,54 @@ def rename_cols(df: pd.DataFrame, rename_map: dict):
             raise ValueError(f"Multiple matches for column: {col}")
         corrected_map[candidate_cols[0]] = new
     return df.rename(columns=corrected_map)
+
+
+def moving_average(values: np.ndarray, window: int, center: bool = True) -> np.ndarray:
+    # Mean of each `window` consecutive samples from differences of one cumulative sum, so the cost doesn't depend
+    # on the window. Same alignment as pandas' rolling(window, center=center); windows running off either end are
+    # NaN, and NaNs inside a window are skipped.
+    values = np.asarray(values, dtype='float64')
+    n = len(values)
+    out = np.full(n, np.nan)
+    if n < window or window < 1:
+        return out
+    valid = ~np.isnan(values)
+    sums = np.concatenate([[0.0], np.cumsum(np.where(valid, values, 0.0))])
+    counts = np.concatenate([[0], np.cumsum(valid)])
+    # Window ending at (exclusive) i + window for each full window starting at i
+    window_sums = sums[window:] - sums[:-window]
+    window_counts = counts[window:] - counts[:-window]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(window_counts > 0, window_sums / np.maximum(window_counts, 1), np.nan)
+    first = (window - 1) - (window - 1) // 2 if center else window - 1
+    out[first:first + len(means)] = means
+    return out
+
+
+def minmax_downsample(values: np.ndarray, n_buckets: int) -> np.ndarray:
+    # Positions of the smallest and largest value in each of `n_buckets` equal runs of samples, in order. Drawn as
+    # a line, 2 * n_buckets points look the same as all of them at n_buckets pixels wide: every spike survives.
+    # A bucket with NaNs also keeps the position of its first one, so a line drawn through the result still breaks
+    # where the data has gaps.
+    values = np.asarray(values, dtype='float64')
+    n = len(values)
+    if n <= 2 * n_buckets:
+        return np.arange(n)
+    size = -(-n // n_buckets)
+    n_buckets = -(-n // size)
+    padded = np.full(n_buckets * size, np.nan)
+    padded[:n] = values
+    buckets = padded.reshape(n_buckets, size)
+    is_nan = np.isnan(buckets)
+    is_nan.ravel()[n:] = False  # Padding, not a gap
+    all_nan = np.isnan(buckets).all(axis=1)
+    # nanargmin/nanargmax raise on all-NaN rows
+    filled = np.where(all_nan[:, None], 0.0, buckets)
+    starts = np.arange(n_buckets) * size
+    lo = starts + np.nanargmin(filled, axis=1)
+    hi = starts + np.nanargmax(filled, axis=1)
+    has_nan = is_nan.any(axis=1)
+    first_nan = starts + np.argmax(is_nan, axis=1)
+    positions = np.sort(np.concatenate([lo[~all_nan], hi[~all_nan], first_nan[has_nan]]))
+    # Flat buckets pick the same sample twice
+    return positions[np.concatenate([[True], np.diff(positions) > 0])] if len(positions) else positions
@@ -0,0 +1,203 @@
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import metrics
+
+USER_AGENT = 'nykp-conditions (https://github.com/nykp/noaa-currents)'
+DEFAULT_POOL_SIZE = 8
+DEFAULT_TIMEOUT = (3.05, 30)  # (connect, read) seconds; the read timeout is per socket read, not the whole body
+DEFAULT_PER_HOST_LIMIT = 6
+# Hosts that want fewer requests in flight than the default
+HOST_LIMITS = {
+    'api.weather.gov': 4,
+}
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_SECONDS = 60.0
+MAX_RETRY_AFTER_SECONDS = 60.0
+
+
+class CircuitOpenError(requests.ConnectionError):
+    # A RequestException, so callers that fall back on errors (e.g. serving stale cache entries) do so here too
+    pass
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_retries: int = 3
+    backoff_base: float = 0.5
+    backoff_max: float = 10.0
+    retry_statuses: FrozenSet[int] = frozenset({429, 500, 502, 503, 504})
+    retry_methods: FrozenSet[str] = frozenset({'GET', 'HEAD'})
+
+    def backoff(self, attempt: int) -> float:
+        # "Full jitter": uniform over the exponential window, so retrying clients don't move in lockstep
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    # Opens after `failure_threshold` consecutive failed attempts, failing fast for `reset_seconds`. Then one trial
+    # request is let through: success closes the circuit, failure opens it for another period.
+
+    def __init__(
+            self, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD, reset_seconds: float = DEFAULT_RESET_SECONDS
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.reset_seconds:
+                self._opened_at = time.monotonic()  # Only this trial gets through until it reports back
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+def make_session(pool_size: int = DEFAULT_POOL_SIZE) -> requests.Session:
+    # pool_block keeps us from opening more than pool_size sockets per host, even with more threads than that
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['User-Agent'] = USER_AGENT
+    return session
+
+
+def _retry_after(resp: requests.Response) -> float:
+    try:
+        return min(float(resp.headers.get('Retry-After', 0)), MAX_RETRY_AFTER_SECONDS)
+    except ValueError:  # An HTTP date rather than seconds
+        return 0.0
+
+
+class Transport:
+    # The one way out to the network: a keep-alive session (the pluggable backend; anything with
+    # requests.Session.request's signature works, e.g. one replaying recorded responses) wrapped with default
+    # timeouts, retries with jittered exponential backoff, and a concurrency limit and circuit breaker per host.
+
+    def __init__(
+            self,
+            session: Optional[requests.Session] = None,
+            timeout: Tuple[float, float] = DEFAULT_TIMEOUT,
+            retry: Optional[RetryPolicy] = None,
+            per_host_limit: int = DEFAULT_PER_HOST_LIMIT,
+            host_limits: Optional[Dict[str, int]] = None,
+            failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+            reset_seconds: float = DEFAULT_RESET_SECONDS,
+    ):
+        self.session = make_session() if session is None else session
+        self.timeout = timeout
+        self.retry = RetryPolicy() if retry is None else retry
+        self.per_host_limit = per_host_limit
+        self.host_limits = HOST_LIMITS if host_limits is None else host_limits
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._limiters: Dict[str, threading.BoundedSemaphore] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def _host_state(self, host: str) -> Tuple[threading.BoundedSemaphore, CircuitBreaker]:
+        with self._lock:
+            if host not in self._limiters:
+                self._limiters[host] = threading.BoundedSemaphore(self.host_limits.get(host, self.per_host_limit))
+                self._breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_seconds)
+            return self._limiters[host], self._breakers[host]
+
+    def breaker(self, url: str) -> CircuitBreaker:
+        return self._host_state(urlparse(url).netloc)[1]
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        # Returns the final response whatever its status; callers still raise_for_status() as they see fit
+        host = urlparse(url).netloc
+        limiter, breaker = self._host_state(host)
+        kwargs.setdefault('timeout', self.timeout)
+        retryable = method.upper() in self.retry.retry_methods
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                metrics.incr('http_circuit_open', host=host)
+                raise CircuitOpenError(f'Not requesting {url}: {host} failed {self.failure_threshold} times in a row')
+            try:
+                with limiter, metrics.span('http_request', host=host):
+                    resp = self.session.request(method, url, **kwargs)
+                    metrics.incr('http_bytes', len(resp.content), host=host)
+                metrics.incr('http_requests', host=host, status=resp.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.incr('http_errors', host=host, error=type(e).__name__)
+                breaker.record_failure()
+                if not retryable or attempt >= self.retry.max_retries:
+                    raise
+                delay = self.retry.backoff(attempt)
+            else:
+                if resp.status_code >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                if (not retryable or attempt >= self.retry.max_retries
+                        or resp.status_code not in self.retry.retry_statuses):
+                    return resp
+                delay = max(self.retry.backoff(attempt), _retry_after(resp))
+                resp.close()
+            metrics.incr('http_retries', host=host)
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+
+_transport: Optional[Transport] = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> Transport:
+    # Shared transport, so repeated requests to the same host reuse connections and share its limits and breaker
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = Transport()
+        return _transport
+
+
+def set_transport(transport: Optional[Transport]) -> Optional[Transport]:
+    global _transport
+    with _transport_lock:
+        previous, _transport = _transport, transport
+        return previous
+
+
+def get_session() -> requests.Session:
+    return get_transport().session
+
+
+def set_session(session: Optional[requests.Session]) -> Optional[requests.Session]:
+    # Swap the shared transport's backend (e.g. for one that records or replays responses); returns the previous one
+    transport = get_transport()
+    previous, transport.session = transport.session, make_session() if session is None else session
+    return previous
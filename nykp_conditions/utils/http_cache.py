@@ -0,0 +1,211 @@
+import atexit
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+import time
+import weakref
+from dataclasses import asdict, dataclass
+from typing import Dict, Optional, Tuple
+
+import requests
+
+from .http import get_transport
+from .metrics import metrics
+
+HTTP_CACHE_DIR = os.path.abspath(os.path.join(__file__, '../../../cache/http'))
+INDEX_FILENAME = 'index.json'
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_TTL = 5 * 60
+
+# Seconds a cached response is served without revalidating
+SOURCE_TTLS = {
+    'noaa_currents': 30 * 24 * 60 * 60,  # Predictions for a given station and date never change
+    'noaa_harmonics': 365 * 24 * 60 * 60,
+    'water_temps': 6 * 60,  # Observations come in every 6 minutes
+    'nws_forecast': 30 * 60,
+    'nws_precip': 10 * 60,
+    'nws_precip_history': 7 * 24 * 60 * 60,  # Observations for days that are over, barring late corrections
+    'notify_nyc': 60,
+}
+
+# Caches with last_used times not yet written out, flushed at exit
+_open_caches = weakref.WeakSet()
+
+
+@dataclass
+class CacheEntry:
+    url: str
+    filename: str
+    size: int
+    fetched_at: float
+    last_used: float
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+class HttpCache:
+    def __init__(
+            self,
+            path: str = HTTP_CACHE_DIR,
+            max_bytes: int = DEFAULT_MAX_BYTES,
+            ttls: Optional[Dict[str, float]] = None,
+            stale_on_error: bool = True,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttls = SOURCE_TTLS if ttls is None else ttls
+        self.stale_on_error = stale_on_error
+        self._lock = threading.RLock()
+        self._index: Optional[Dict[str, CacheEntry]] = None
+        self._dirty = False
+        _open_caches.add(self)
+
+    @property
+    def index(self) -> Dict[str, CacheEntry]:
+        if self._index is None:
+            index_path = os.path.join(self.path, INDEX_FILENAME)
+            try:
+                with open(index_path) as f:
+                    self._index = {k: CacheEntry(**v) for k, v in json.load(f).items()}
+            except (FileNotFoundError, json.JSONDecodeError, TypeError):
+                self._index = {}
+        return self._index
+
+    def ttl(self, source: Optional[str]) -> float:
+        return self.ttls.get(source, DEFAULT_TTL)
+
+    def retrieve(self, url: str, source: Optional[str] = None, **kwargs) -> str:
+        # Path to an up-to-date local copy of `url`, downloading or revalidating it as needed
+        path, _ = self._get(url, source=source, **kwargs)
+        return path
+
+    def read(self, url: str, source: Optional[str] = None, **kwargs) -> bytes:
+        path, body = self._get(url, source=source, **kwargs)
+        if body is None:
+            with open(path, 'rb') as f:
+                body = f.read()
+        return body
+
+    def _get(self, url: str, source: Optional[str] = None, ttl: Optional[float] = None,
+             stale_on_error: Optional[bool] = None) -> Tuple[str, Optional[bytes]]:
+        # Freshly downloaded bodies are handed back directly, so readers don't go back to disk for them
+        if ttl is None:
+            ttl = self.ttl(source)
+        if stale_on_error is None:
+            stale_on_error = self.stale_on_error
+        key = hashlib.sha1(url.encode()).hexdigest()
+        with self._lock:
+            entry = self.index.get(key)
+            if entry is not None and not os.path.exists(self._body_path(entry)):
+                entry = None
+            now = time.time()
+            if entry is not None and now - entry.fetched_at < ttl:
+                metrics.incr('http_cache_hits', cache_source=source)
+                # Only in memory; it's written with the next fetch or eviction, or at exit
+                entry.last_used = now
+                self._dirty = True
+                return self._body_path(entry), None
+
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        try:
+            resp = get_transport().get(url, headers=headers)
+            if resp.status_code == 304 and entry is not None:
+                metrics.incr('http_cache_revalidated', cache_source=source)
+                with self._lock:
+                    entry.fetched_at = entry.last_used = time.time()
+                    self._save_index()
+                return self._body_path(entry), None
+            resp.raise_for_status()
+        except requests.RequestException as e:
+            if stale_on_error and entry is not None:
+                metrics.incr('http_cache_stale', cache_source=source, error=type(e).__name__)
+                return self._body_path(entry), None
+            raise
+        metrics.incr('http_cache_misses', cache_source=source)
+        body = resp.content
+        resp_headers = resp.headers
+
+        with self._lock:
+            now = time.time()
+            content_type = (resp_headers.get('Content-Type') or '').split(';')[0].strip()
+            suffix = mimetypes.guess_extension(content_type) or '.body'
+            if entry is not None and entry.filename != f'{key}{suffix}':
+                self._remove(entry)
+            entry = CacheEntry(url=url, filename=f'{key}{suffix}', size=len(body), fetched_at=now, last_used=now,
+                               etag=resp_headers.get('ETag'),
+                               last_modified=resp_headers.get('Last-Modified'))
+            os.makedirs(self.path, exist_ok=True)
+            body_path = self._body_path(entry)
+            tmp_path = f'{body_path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(body)
+            os.replace(tmp_path, body_path)
+            self.index[key] = entry
+            self._evict()
+            self._save_index()
+            return body_path, body
+
+    def clear(self):
+        with self._lock:
+            for entry in list(self.index.values()):
+                self._remove(entry)
+            self.index.clear()
+            self._save_index()
+
+    def flush(self):
+        # Writes out last_used times from cache hits since the index was last saved
+        with self._lock:
+            if self._dirty and os.path.isdir(self.path):
+                self._save_index()
+
+    def _body_path(self, entry: CacheEntry) -> str:
+        return os.path.join(self.path, entry.filename)
+
+    def _remove(self, entry: CacheEntry):
+        try:
+            os.remove(self._body_path(entry))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        # Least recently used first, until we're back under the size bound
+        total = sum(e.size for e in self.index.values())
+        for key, entry in sorted(self.index.items(), key=lambda kv: kv[1].last_used):
+            if total <= self.max_bytes:
+                break
+            self._remove(entry)
+            del self.index[key]
+            total -= entry.size
+
+    def _save_index(self):
+        os.makedirs(self.path, exist_ok=True)
+        index_path = os.path.join(self.path, INDEX_FILENAME)
+        tmp_path = f'{index_path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({k: asdict(v) for k, v in self.index.items()}, f)
+        os.replace(tmp_path, index_path)
+        self._dirty = False
+
+
+@atexit.register
+def _flush_caches():
+    for cache in list(_open_caches):
+        cache.flush()
+
+
+default_cache = HttpCache()
+
+
+def cached_retrieve(url: str, source: Optional[str] = None, **kwargs) -> str:
+    return default_cache.retrieve(url, source=source, **kwargs)
+
+
+def cached_read(url: str, source: Optional[str] = None, **kwargs) -> bytes:
+    return default_cache.read(url, source=source, **kwargs)
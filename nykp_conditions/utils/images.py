@@ -0,0 +1,151 @@
+import io
+import os
+from dataclasses import dataclass, replace
+from typing import Iterator, Optional, Tuple
+
+from .metrics import metrics
+from .plot import DEFAULT_DPI
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow normally comes with matplotlib; without it images go out as they are
+    Image = None
+
+PALETTE_STEPS = (256, 128, 64, 32, 16)
+WEBP_QUALITY_STEPS = (90, 75, 60, 45)
+SCALE_STEP = 0.8  # Shrink by this much at a time when the budget still isn't met
+MIN_SCALED_WIDTH = 480
+# Leading bytes of the formats images come in as, for telling them apart without Pillow
+MAGIC_BYTES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'\xff\xd8\xff', 'jpeg'),
+)
+
+
+class ImageBudgetError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class ImageOutput:
+    # How images get written before they're uploaded
+    dpi: int = DEFAULT_DPI  # For figures we render ourselves
+    max_width: Optional[int] = 1200  # Pixels; larger images are scaled down to fit
+    max_height: Optional[int] = None
+    colors: Optional[int] = 256  # Palette size for PNGs, or None to keep full color
+    webp: bool = False
+    max_bytes: Optional[int] = 150_000  # Per image; smaller palettes, lossier WebP, then smaller sizes until it fits
+
+    def with_overrides(self, webp: Optional[bool] = None, max_kb: Optional[float] = None) -> 'ImageOutput':
+        # For the scripts' --webp and --max-image-kb flags
+        output = self if webp is None else replace(self, webp=webp)
+        return output if max_kb is None else replace(output, max_bytes=int(max_kb * 1000))
+
+
+DEFAULT_IMAGE_OUTPUT = ImageOutput()
+
+
+@dataclass
+class OutputImage:
+    data: bytes
+    format: str  # 'png', 'webp', or whatever came in when it's passed through
+    original_bytes: int
+    size: Optional[Tuple[int, int]] = None  # (width, height)
+
+    @property
+    def extension(self) -> str:
+        return f'.{self.format}'
+
+    def filename(self, filename: Optional[str]) -> Optional[str]:
+        # `filename` with the extension of what it now is
+        if filename is None:
+            return None
+        return os.path.splitext(filename)[0] + self.extension
+
+
+def _fit(img, max_width: Optional[int], max_height: Optional[int]):
+    scale = 1.0
+    if max_width is not None and img.width > max_width:
+        scale = max_width / img.width
+    if max_height is not None and img.height * scale > max_height:
+        scale = max_height / img.height
+    if scale >= 1.0:
+        return img
+    return img.resize((max(round(img.width * scale), 1), max(round(img.height * scale), 1)), Image.Resampling.LANCZOS)
+
+
+def _encodings(img, output: ImageOutput) -> Iterator[bytes]:
+    # Candidate encodings of one size, from best looking to smallest
+    rgb = img.convert('RGB')
+    if output.webp:
+        buffer = io.BytesIO()
+        rgb.save(buffer, format='WEBP', lossless=True, method=4)
+        yield buffer.getvalue()
+        for quality in WEBP_QUALITY_STEPS:
+            buffer = io.BytesIO()
+            rgb.save(buffer, format='WEBP', quality=quality, method=4)
+            yield buffer.getvalue()
+        return
+    if output.colors is None:
+        buffer = io.BytesIO()
+        rgb.save(buffer, format='PNG', optimize=True)
+        yield buffer.getvalue()
+        return
+    # Plots are mostly a handful of flat colors, so a palette loses next to nothing
+    for colors in [c for c in PALETTE_STEPS if c <= output.colors] or [output.colors]:
+        buffer = io.BytesIO()
+        rgb.quantize(colors=colors, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE).save(
+            buffer, format='PNG', optimize=True)
+        yield buffer.getvalue()
+
+
+def compact_image(data: bytes, output: ImageOutput = DEFAULT_IMAGE_OUTPUT, name: str = 'image') -> OutputImage:
+    # Re-encodes image bytes per `output`, records the sizes in the run metrics, and raises ImageBudgetError if even
+    # the smallest candidate is over output.max_bytes
+    with metrics.span('image_output', image=name):
+        result = _compact(data, output)
+    metrics.incr('image_input_bytes', len(data), image=name)
+    metrics.incr('image_output_bytes', len(result.data), image=name)
+    if output.max_bytes is not None and len(result.data) > output.max_bytes:
+        metrics.incr('image_over_budget', image=name)
+        raise ImageBudgetError(f'{name} is {len(result.data)} bytes after compaction, '
+                               f'over the budget of {output.max_bytes}')
+    return result
+
+
+def _sniff_format(data: bytes) -> str:
+    for magic, fmt in MAGIC_BYTES:
+        if data.startswith(magic):
+            return fmt
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return 'png'  # What nearly everything here is; the upload still works, it just gets the wrong extension
+
+
+def _compact(data: bytes, output: ImageOutput) -> OutputImage:
+    if Image is None:
+        return OutputImage(data, _sniff_format(data), len(data))
+    original = Image.open(io.BytesIO(data))
+    original.load()
+    source_format = (original.format or 'png').lower()
+    img = _fit(original, output.max_width, output.max_height)
+    fmt = 'webp' if output.webp else 'png'
+    # The original goes out as it is if it's already the right format and size, and re-encoding doesn't shrink it
+    passthrough = OutputImage(data, fmt, len(data), original.size) \
+        if img is original and source_format == fmt else None
+
+    smallest = None
+    while True:
+        for encoded in _encodings(img, output):
+            candidate = OutputImage(encoded, fmt, len(data), img.size)
+            if smallest is None or len(encoded) < len(smallest.data):
+                smallest = candidate
+            if output.max_bytes is None or len(encoded) <= output.max_bytes:
+                if passthrough is not None and len(data) <= len(encoded):
+                    return passthrough
+                return candidate
+        if img.width * SCALE_STEP < MIN_SCALED_WIDTH:
+            return smallest
+        img = img.resize((round(img.width * SCALE_STEP), round(img.height * SCALE_STEP)), Image.Resampling.LANCZOS)
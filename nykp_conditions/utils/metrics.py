@@ -0,0 +1,181 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+METRICS_DIR_ENV = 'NYKP_METRICS_DIR'
+JSONL_FILENAME = 'metrics.jsonl'
+PROMETHEUS_PREFIX = 'nykp'
+
+# Which source the current thread is working for, so spans and counters deep in shared code (HTTP, cache, Slack)
+# can be broken down per source. Set by the source runners; thread pools need it set again inside the task.
+_current_source: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('metrics_source', default=None)
+
+_LabelKey = Tuple[Tuple[str, str], ...]
+
+
+@dataclass
+class Span:
+    name: str
+    start: float  # Unix time
+    seconds: float
+    labels: Dict[str, str] = field(default_factory=dict)
+    error: Optional[str] = None
+
+
+class Metrics:
+    # Timing spans and counters for one run; cheap enough to always collect, and only written out when asked to
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, script: Optional[str] = None):
+        with self._lock:
+            self.script = script
+            self.started_at = time.time()
+            self.spans: List[Span] = []
+            self.counters: Dict[Tuple[str, _LabelKey], float] = defaultdict(float)
+
+    @staticmethod
+    def _labels(labels: Dict[str, object]) -> Dict[str, str]:
+        source = _current_source.get()
+        if source is not None and 'source' not in labels:
+            labels = {'source': source, **labels}
+        return {k: str(v) for k, v in labels.items()}
+
+    @contextmanager
+    def span(self, name: str, **labels) -> Iterator[None]:
+        labels = self._labels(labels)
+        start, t0 = time.time(), time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            span = Span(name, start, time.perf_counter() - t0, labels, error)
+            with self._lock:
+                self.spans.append(span)
+
+    def incr(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(self._labels(labels).items())))
+        with self._lock:
+            self.counters[key] += value
+
+    def write_jsonl(self, path: str, **extra):
+        # One line per span and counter, appended, so the file accumulates runs
+        run = {'script': self.script, 'run_started_at': self.started_at, **extra}
+        with self._lock:
+            lines = [{'type': 'span', **run, **asdict(span)} for span in self.spans]
+            lines += [{'type': 'counter', **run, 'name': name, 'labels': dict(labels), 'value': value}
+                      for (name, labels), value in self.counters.items()]
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'a') as f:
+            f.writelines(json.dumps(line) + '\n' for line in lines)
+
+    def prometheus_text(self, success: bool = True) -> str:
+        # Gauges describing the latest run, in the text exposition format the node exporter's textfile collector reads
+        base = {'script': self.script or 'unknown'}
+        with self._lock:
+            span_totals: Dict[_LabelKey, List[float]] = defaultdict(lambda: [0.0, 0])
+            for span in self.spans:
+                key = tuple(sorted({**base, **span.labels, 'span': span.name}.items()))
+                span_totals[key][0] += span.seconds
+                span_totals[key][1] += 1
+            counters = dict(self.counters)
+        lines = [f'# TYPE {PROMETHEUS_PREFIX}_span_seconds_sum gauge',
+                 f'# TYPE {PROMETHEUS_PREFIX}_span_seconds_count gauge']
+        for key, (seconds, count) in sorted(span_totals.items()):
+            lines.append(f'{PROMETHEUS_PREFIX}_span_seconds_sum{_format_labels(key)} {seconds:.6f}')
+            lines.append(f'{PROMETHEUS_PREFIX}_span_seconds_count{_format_labels(key)} {count}')
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f'# TYPE {PROMETHEUS_PREFIX}_{name}_total gauge')
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == name:
+                    key = tuple(sorted({**base, **dict(labels)}.items()))
+                    lines.append(f'{PROMETHEUS_PREFIX}_{name}_total{_format_labels(key)} {value:g}')
+        base_labels = _format_labels(tuple(base.items()))
+        lines += [f'# TYPE {PROMETHEUS_PREFIX}_run_timestamp_seconds gauge',
+                  f'{PROMETHEUS_PREFIX}_run_timestamp_seconds{base_labels} {self.started_at:.3f}',
+                  f'# TYPE {PROMETHEUS_PREFIX}_run_duration_seconds gauge',
+                  f'{PROMETHEUS_PREFIX}_run_duration_seconds{base_labels} {time.time() - self.started_at:.6f}',
+                  f'# TYPE {PROMETHEUS_PREFIX}_run_success gauge',
+                  f'{PROMETHEUS_PREFIX}_run_success{base_labels} {int(success)}']
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus_textfile(self, path: str, success: bool = True):
+        # Written to a temporary file and renamed, so the collector never reads a partial file
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus_text(success=success))
+        os.replace(tmp_path, path)
+
+    def export(self, metrics_dir: str, success: bool = True):
+        self.write_jsonl(os.path.join(metrics_dir, JSONL_FILENAME), success=success)
+        self.write_prometheus_textfile(os.path.join(metrics_dir, f'{PROMETHEUS_PREFIX}_{self.script}.prom'),
+                                       success=success)
+
+
+def _format_labels(labels: _LabelKey) -> str:
+    if not labels:
+        return ''
+    escaped = (f'{k}="{_escape_label_value(v)}"' for k, v in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics()
+
+
+def span(name: str, **labels):
+    return metrics.span(name, **labels)
+
+
+def incr(name: str, value: float = 1, **labels):
+    metrics.incr(name, value, **labels)
+
+
+def current_source() -> Optional[str]:
+    return _current_source.get()
+
+
+@contextmanager
+def source_context(source: Optional[str]) -> Iterator[None]:
+    token = _current_source.set(source)
+    try:
+        yield
+    finally:
+        _current_source.reset(token)
+
+
+def propagate_source(fn: Callable) -> Callable:
+    # Wraps fn so it runs under the caller's source wherever it's called, e.g. on a thread pool worker
+    source = _current_source.get()
+
+    def _wrapped(*args, **kwargs):
+        with source_context(source):
+            return fn(*args, **kwargs)
+    return _wrapped
+
+
+def timed(name: str, **labels) -> Callable[[Callable], Callable]:
+    # Decorator form of span
+    def _decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def _wrapped(*args, **kwargs):
+            with metrics.span(name, **labels):
+                return fn(*args, **kwargs)
+        return _wrapped
+    return _decorator
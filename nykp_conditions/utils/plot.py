@@ -1,5 +1,22 @@
+import io
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Callable, Optional, Sequence, Tuple
+
 import matplotlib as mpl
-import matplotlib.pyplot as plt
+import matplotlib.dates
+from matplotlib.axes import Axes
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from .metrics import metrics
+
+DEFAULT_FIGSIZE = (10, 4)
+DEFAULT_DPI = 100
+SAVEFIG_KWARGS = {'bbox_inches': 'tight', 'pad_inches': 0.25}
+
+_local = threading.local()
 
 
 class DateTimeFormats:
@@ -12,6 +29,7 @@ class DateTimeFormats:
 
 def format_time_axis(ax=None, fmt=DateTimeFormats.h_m_s, axis=0):
     if ax is None:
+        import matplotlib.pyplot as plt
         ax = plt.gca()
     if axis in (0, 'x', 'X'):
         axis = 0
@@ -23,3 +41,68 @@ def format_time_axis(ax=None, fmt=DateTimeFormats.h_m_s, axis=0):
         ax.xaxis.set_major_formatter(mpl.dates.DateFormatter(fmt))
     else:
         ax.yaxis.set_major_formatter(mpl.dates.DateFormatter(fmt))
+
+
+@lru_cache(maxsize=None)
+def theme_rc() -> dict:
+    # The seaborn darkgrid look as plain rcParams, computed once instead of sns.set_theme() on every plot
+    try:
+        import seaborn as sns
+    except ImportError:
+        return {}
+    rc = {}
+    rc.update(sns.axes_style('darkgrid'))
+    rc.update(sns.plotting_context('notebook'))
+    return rc
+
+
+def _template_figure(figsize: Tuple[float, float], dpi: int) -> Figure:
+    # One figure per thread and size, cleared and reused between renders. These figures never touch pyplot, so
+    # there's no global figure registry to leak into and no GUI backend involved.
+    figures = getattr(_local, 'figures', None)
+    if figures is None:
+        figures = _local.figures = {}
+    key = (tuple(figsize), dpi)
+    fig = figures.get(key)
+    if fig is None:
+        with mpl.rc_context(theme_rc()):
+            fig = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(fig)
+        figures[key] = fig
+    else:
+        fig.clear()
+    return fig
+
+
+def render_figure(
+        draw: Callable[[Axes], None],
+        path: Optional[str] = None,
+        figsize: Tuple[float, float] = DEFAULT_FIGSIZE,
+        dpi: int = DEFAULT_DPI,
+        fmt: str = 'png',
+        **savefig_kwargs,
+) -> str | bytes:
+    # Calls draw(ax) on a themed Agg figure. Writes to `path` if given, otherwise returns the image bytes.
+    savefig_kwargs = {**SAVEFIG_KWARGS, **savefig_kwargs}
+    with metrics.span('plot'), mpl.rc_context(theme_rc()):
+        fig = _template_figure(figsize, dpi)
+        try:
+            ax = fig.add_subplot()
+            draw(ax)
+            if path is not None:
+                fig.savefig(path, format=fmt, **savefig_kwargs)
+                return path
+            buffer = io.BytesIO()
+            fig.savefig(buffer, format=fmt, **savefig_kwargs)
+            return buffer.getvalue()
+        finally:
+            fig.clear()
+
+
+def render_many(render: Callable, arg_tuples: Sequence[tuple], processes: Optional[int] = None) -> list:
+    # Runs render(*args) for each tuple in a process pool; `render` and its args must be picklable
+    if len(arg_tuples) <= 1 or processes == 1:
+        return [render(*args) for args in arg_tuples]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(render, *args) for args in arg_tuples]
+        return [f.result() for f in futures]
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+POSTED_INDEX_PATH = os.path.abspath(os.path.join(__file__, '../../../cache/slack_posted.json'))
+POSTED_RETENTION_DAYS = 7  # After this long, unchanged content gets posted again
+DEFAULT_SOURCE = 'default'
+
+
+def _json_default(obj):
+    # slack_sdk models (Attachment, blocks) hash by what they'd send
+    to_dict = getattr(obj, 'to_dict', None)
+    return to_dict() if to_dict is not None else str(obj)
+
+
+def content_hash(text: Optional[str], file: Optional[str | bytes] = None, attachments: Optional[list] = None,
+                 kwargs: Optional[dict] = None) -> str:
+    # Everything that shows up in the channel. Filenames are left out; some carry the time they were rendered.
+    h = hashlib.sha256()
+    message = {'text': text, 'attachments': attachments, 'kwargs': kwargs or {}}
+    h.update(json.dumps(message, sort_keys=True, default=_json_default).encode())
+    if isinstance(file, str):
+        with open(file, 'rb') as f:
+            file = f.read()
+    if file is not None:
+        h.update(b'\0file\0')
+        h.update(file)
+    return h.hexdigest()
+
+
+class PostDedupStore:
+    # Hash of the last content posted to each slot, per channel and source, so reruns can skip posts that haven't
+    # changed. A slot is a post's dedup_key, e.g. one station's table, or the content hash itself for posts without
+    # one (so the same advisory isn't posted twice). With edit_changed, a slot's message is updated in place when its
+    # content does change, instead of posting a new one; files are always uploaded anew.
+
+    def __init__(self, path: str = POSTED_INDEX_PATH, edit_changed: bool = False,
+                 retention_days: float = POSTED_RETENTION_DAYS):
+        self.path = path
+        self.edit_changed = edit_changed
+        self.retention_days = retention_days
+        self._lock = threading.Lock()
+        self._index: Optional[Dict[str, dict]] = None
+
+    @staticmethod
+    def _key(channel: str, source: Optional[str], slot: str) -> str:
+        return f'{channel}|{source or DEFAULT_SOURCE}|{slot}'
+
+    def _load(self) -> Dict[str, dict]:
+        if self._index is None:
+            try:
+                with open(self.path) as f:
+                    self._index = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._index = {}
+        return self._index
+
+    def _save(self):
+        cutoff = time.time() - self.retention_days * 24 * 60 * 60
+        self._index = {k: v for k, v in self._index.items() if v['posted_at'] >= cutoff}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    def get(self, channel: str, source: Optional[str], slot: str) -> Optional[dict]:
+        cutoff = time.time() - self.retention_days * 24 * 60 * 60
+        with self._lock:
+            record = self._load().get(self._key(channel, source, slot))
+        return record if record is not None and record['posted_at'] >= cutoff else None
+
+    def record(self, channel: str, source: Optional[str], slot: str, digest: str, channel_id: Optional[str] = None,
+               ts: Optional[str] = None):
+        # channel_id and ts identify a message that can be edited later
+        with self._lock:
+            self._load()[self._key(channel, source, slot)] = {'hash': digest, 'posted_at': time.time(),
+                                                              'channel_id': channel_id, 'ts': ts}
+            self._save()
+
+
+_store: Optional[PostDedupStore] = None
+_store_lock = threading.Lock()
+
+
+def get_dedup_store() -> PostDedupStore:
+    # Shared store, so every post in the process reads and writes the same index
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = PostDedupStore()
+        return _store
+
+
+def set_dedup_store(store: Optional[PostDedupStore]) -> Optional[PostDedupStore]:
+    global _store
+    with _store_lock:
+        previous, _store = _store, store
+        return previous
+
+
+def resolve_dedup(dedup: bool | PostDedupStore | None) -> Optional[PostDedupStore]:
+    # For `dedup` arguments: True means the shared store, False or None means post everything
+    if isinstance(dedup, PostDedupStore):
+        return dedup
+    return get_dedup_store() if dedup else None
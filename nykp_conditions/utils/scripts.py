@@ -1,8 +1,12 @@
+import os
 import pdb
+import sys
 import traceback
 from argparse import ArgumentParser
 from typing import Callable, Optional, Type
 
+from .metrics import METRICS_DIR_ENV, metrics
+
 
 def str2bool(s: Optional[bool | str], ignore_errors=False) -> Optional[bool | str]:
     try:
@@ -34,13 +38,20 @@ def optional(type_: Type):
 def try_main(main: Callable, arg_parser: ArgumentParser):
     arg_parser.add_argument('--pdb', action='store_true')
     arg_parser.add_argument('--postmortem', action='store_true')
+    arg_parser.add_argument('--metrics-dir', type=str, default=os.environ.get(METRICS_DIR_ENV),
+                            help=f'Append run metrics to metrics.jsonl and write a Prometheus textfile here '
+                                 f'(default: ${METRICS_DIR_ENV})')
     args = arg_parser.parse_args()
 
     if args.pdb:
         pdb.set_trace()
 
+    metrics.reset(script=os.path.splitext(os.path.basename(sys.argv[0]))[0])
+    success = False
     try:
-        main(args)
+        with metrics.span('main'):
+            main(args)
+        success = True
     except (KeyboardInterrupt, pdb.bdb.BdbQuit):
         pass
     except Exception:
@@ -49,3 +60,6 @@ def try_main(main: Callable, arg_parser: ArgumentParser):
             pdb.post_mortem()
         else:
             raise
+    finally:
+        if args.metrics_dir:
+            metrics.export(args.metrics_dir, success=success)
@@ -3,13 +3,20 @@ import os
 SECRETS_DIR = os.path.abspath(os.path.join(__file__, '../../../.secrets'))
 SLACK_BOT_TOKEN_FILE = os.path.join(SECRETS_DIR, 'slack_app_bot_token')
 SLACK_USER_TOKEN_FILE = os.path.join(SECRETS_DIR, 'slack_app_user_token')
+# Environment variables take precedence over the token files
+SLACK_BOT_TOKEN_ENV = 'NYKP_SLACK_BOT_TOKEN'
+SLACK_USER_TOKEN_ENV = 'NYKP_SLACK_USER_TOKEN'
 
 
 def get_slack_bot_token():
+    if os.environ.get(SLACK_BOT_TOKEN_ENV):
+        return os.environ[SLACK_BOT_TOKEN_ENV]
     with open(SLACK_BOT_TOKEN_FILE) as f:
         return f.readlines()[0].strip()
 
 
 def get_slack_user_token():
+    if os.environ.get(SLACK_USER_TOKEN_ENV):
+        return os.environ[SLACK_USER_TOKEN_ENV]
     with open(SLACK_USER_TOKEN_FILE) as f:
         return f.readlines()[0].strip()
@@ -1,9 +1,19 @@
-from typing import Optional
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, Optional
 
 import slack_sdk
 from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
 from slack_sdk.models.attachments import Attachment
 
+from .metrics import current_source, metrics, propagate_source
+from .post_dedup import PostDedupStore, content_hash
 from .secrets import get_slack_bot_token, get_slack_user_token
 
 
@@ -13,13 +23,37 @@ class NykpSlackChannels:
     hudson_sessions = 'hudson-sessions'
 
 
+# chat.postMessage allows about one message per second per channel
+SECONDS_PER_CHANNEL_POST = 1.0
+MAX_RATE_LIMIT_RETRIES = 3
+# Points clients at another Slack API, e.g. the fake one the benchmarks run against
+SLACK_API_URL_ENV = 'NYKP_SLACK_API_URL'
+
+
 def get_client(token=None, user=False):
     if token is None:
-        if user:
-            token = get_slack_user_token()
-        else:
-            token = get_slack_bot_token()
-    return slack_sdk.WebClient(token=token)
+        token = _cached_token(user=user)
+    return _cached_client(token)
+
+
+@lru_cache(maxsize=None)
+def _cached_token(user=False) -> str:
+    return get_slack_user_token() if user else get_slack_bot_token()
+
+
+class _CountedRateLimitRetryHandler(RateLimitErrorRetryHandler):
+    def prepare_for_next_attempt(self, **kwargs):
+        metrics.incr('slack_retries')
+        super().prepare_for_next_attempt(**kwargs)
+
+
+@lru_cache(maxsize=None)
+def _cached_client(token: str) -> slack_sdk.WebClient:
+    # One long-lived client per token. Its retry handler is the only place 429s are retried: it sleeps out
+    # Retry-After for every caller, queued or not.
+    return slack_sdk.WebClient(token=token,
+                               base_url=os.environ.get(SLACK_API_URL_ENV, slack_sdk.WebClient.BASE_URL),
+                               retry_handlers=[_CountedRateLimitRetryHandler(max_retry_count=MAX_RATE_LIMIT_RETRIES)])
 
 
 def post_message(text: Optional[str], channel=NykpSlackChannels.test_python_api, client=None, token=None, **kwargs):
@@ -41,14 +75,150 @@ def post_text_attachment(
         text: str, pretext: Optional[str] = None, channel=NykpSlackChannels.test_python_api, client=None,
         token=None, **kwargs
 ):
-    bold_pretext = f"*{pretext}*"
-    attachment = Attachment(text=text)
-    return post_message(text=bold_pretext, channel=channel, client=client, token=token, attachments=[attachment],
+    post = text_attachment_post(text, pretext=pretext)
+    return post_message(text=post.text, channel=channel, client=client, token=token, attachments=post.attachments,
                         **kwargs)
 
 
-def post_file(path: str, channel: str, comment=None, client=None, token=None) -> dict:
+def post_file(file: str | bytes, channel: str, comment=None, client=None, token=None, filename=None) -> dict:
     if client is None:
         client = get_client(token=token)
-    resp = client.files_upload(file=path, channels=channel, initial_comment=comment)
+    resp = client.files_upload(file=file, filename=filename, channels=channel, initial_comment=comment)
     return resp.data['file']
+
+
+def update_message(text: Optional[str], channel_id: str, ts: str, client=None, token=None, **kwargs):
+    # chat.update wants the channel ID from the original post's response, not its name
+    if client is None:
+        client = get_client(token=token)
+    return client.chat_update(channel=channel_id, ts=ts, text=text, **kwargs)
+
+
+@dataclass
+class SlackPost:
+    text: Optional[str] = None
+    attachments: Optional[list] = None
+    file: Optional[str | bytes] = None
+    filename: Optional[str] = None
+    kwargs: dict = field(default_factory=dict)
+    dedup_key: Optional[str] = None  # Identifies what this post shows (e.g. a station), across runs of its source
+
+    def content_hash(self) -> str:
+        return content_hash(self.text, file=self.file, attachments=self.attachments, kwargs=self.kwargs)
+
+
+def send_post(post: SlackPost, channel: str, client=None, token=None, dedup: Optional[PostDedupStore] = None):
+    # With a dedup store, posts whose content is unchanged since the last one in their slot are skipped (returning
+    # None), and changed messages may be edited in place
+    kind = 'file' if post.file else 'message'
+    if dedup is not None:
+        source, digest = current_source(), post.content_hash()
+        slot = post.dedup_key or digest
+        previous = dedup.get(channel, source, slot)
+        if previous is not None and previous['hash'] == digest:
+            metrics.incr('slack_posts_skipped', kind=kind)
+            return None
+        if previous is not None and previous['ts'] and dedup.edit_changed and not post.file:
+            try:
+                with metrics.span('slack_post', kind='edit'):
+                    result = update_message(post.text, previous['channel_id'], previous['ts'], client=client,
+                                            token=token, attachments=post.attachments, **post.kwargs)
+            except SlackApiError as e:
+                if e.response.get('error') != 'message_not_found':
+                    raise
+                # Someone deleted the earlier message; post a fresh one, which then becomes the one to edit
+                metrics.incr('slack_edit_fallbacks', kind=kind)
+            else:
+                metrics.incr('slack_posts', kind='edit')
+                dedup.record(channel, source, slot, digest, channel_id=previous['channel_id'], ts=previous['ts'])
+                return result
+
+    with metrics.span('slack_post', kind=kind):
+        if post.file:
+            result = post_file(post.file, channel, comment=post.text, client=client, token=token,
+                               filename=post.filename)
+        else:
+            result = post_message(post.text, channel=channel, client=client, token=token,
+                                  attachments=post.attachments, **post.kwargs)
+    metrics.incr('slack_posts', kind=kind)
+    if dedup is not None:
+        if post.file:
+            dedup.record(channel, source, slot, digest)
+        else:
+            dedup.record(channel, source, slot, digest, channel_id=result.get('channel'), ts=result.get('ts'))
+    return result
+
+
+def text_attachment_post(text: str, pretext: Optional[str] = None) -> SlackPost:
+    return SlackPost(text=f"*{pretext}*", attachments=[Attachment(text=text)])
+
+
+class SlackPostQueue:
+    # Posts to different channels go out concurrently; each channel keeps submission order and is paced to Slack's
+    # per-channel rate limit. A 429 that still happens is waited out by the client's retry handler.
+
+    def __init__(self, client=None, token=None, min_interval: Optional[float] = None,
+                 dedup: Optional[PostDedupStore] = None):
+        self.client = client if client is not None else get_client(token=token)
+        self.min_interval = SECONDS_PER_CHANNEL_POST if min_interval is None else min_interval
+        self.dedup = dedup
+        self._queues: Dict[str, queue.Queue] = {}
+        self._workers: Dict[str, threading.Thread] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, post: SlackPost, channel: str, dedup: bool = True) -> Future:
+        # dedup=False always sends, for posts that should go out every time even when they repeat
+        future = Future()
+        with self._lock:
+            if channel not in self._queues:
+                self._queues[channel] = queue.Queue()
+                worker = threading.Thread(target=self._run, args=(channel,), name=f'slack-{channel}', daemon=True)
+                self._workers[channel] = worker
+                worker.start()
+            # The worker sends under the submitter's source, so posts are counted against it
+            self._queues[channel].put((post, future, propagate_source(send_post), self.dedup if dedup else None))
+        return future
+
+    def join(self):
+        for q in list(self._queues.values()):
+            q.join()
+
+    def close(self):
+        self.join()
+        with self._lock:
+            for q in self._queues.values():
+                q.put(None)
+            workers = list(self._workers.values())
+            self._queues.clear()
+            self._workers.clear()
+        for worker in workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self, channel: str):
+        q = self._queues[channel]
+        last_sent = 0.0
+        while True:
+            item = q.get()
+            if item is None:
+                q.task_done()
+                return
+            post, future, send, dedup = item
+            try:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                time.sleep(max(0.0, last_sent + self.min_interval - time.monotonic()))
+                try:
+                    result = send(post, channel, client=self.client, dedup=dedup)
+                finally:
+                    last_sent = time.monotonic()
+                future.set_result(result)
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                q.task_done()
@@ -2,11 +2,20 @@ from typing import Optional
 
 import numpy as np
 
+MPH_PER_KNOT = 1.15078
+
 
 def knots_to_mph(knots) -> Optional[float]:
     try:
         if isinstance(knots, str):
             knots = float(knots)
-        return knots * 1.15078
+        return knots * MPH_PER_KNOT
     except (TypeError, ValueError):
         return np.nan
+
+
+MM_PER_INCH = 25.4
+
+
+def mm_to_inches(mm):
+    return mm / MM_PER_INCH
@@ -1,38 +1,36 @@
 import json
 import os
 from argparse import ArgumentParser
-from dataclasses import dataclass
-from typing import Optional
-from urllib.request import urlretrieve
+from dataclasses import asdict, dataclass
+from functools import partial
+from typing import List, Optional, Sequence, Tuple
 
-import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import pendulum
-import seaborn as sns
 from matplotlib.dates import DateFormatter
-from matplotlib.transforms import Bbox
 
-from utils.plot import DateTimeFormats, format_time_axis
-from utils.scripts import try_main
-from utils.slack import NykpSlackChannels, post_message, post_file
+from utils.archive import ARCHIVE_DIR, MemmapArchive
+from utils.data import minmax_downsample, moving_average
+from utils.http_cache import cached_read
+from utils.images import DEFAULT_IMAGE_OUTPUT, ImageBudgetError, ImageOutput, compact_image
+from utils.metrics import timed
+from utils.plot import DEFAULT_DPI, DateTimeFormats, render_figure, render_many
+from utils.post_dedup import PostDedupStore, resolve_dedup
+from utils.scripts import str2bool, try_main
+from utils.slack import NykpSlackChannels, SlackPost, send_post
 
 WATER_TEMPS_URL_BASE = 'https://api.tidesandcurrents.noaa.gov/api/prod/datagetter'
 OBSERVATIONS_URL_TEMPLATE = 'https://tidesandcurrents.noaa.gov/stationhome.html?id={id}#obs'
 THE_BATTERY_STATION_ID = '8518750'
 
-CACHE_DIR = './cache'
-_cleanup_paths = []
-
-
-def _init_cache(path=CACHE_DIR):
-    path_dirs = path.split('/')
-    node = path_dirs[0]
-    if not os.path.exists(node):
-        _cleanup_paths.append(node)
-    for d in path_dirs[1:]:
-        node += '/' + d
-        if not os.path.exists(node):
-            _cleanup_paths.append(node)
+DATA_TIME_FMT = '%Y-%m-%d %H:%M'
+RANGE_DATE_FMT = '%Y%m%d%%20%H:%M'
+MAX_DAYS_PER_REQUEST = 30
+DEFAULT_BACKFILL_DAYS = 30
+ARCHIVE_DTYPE = np.dtype([('t', 'datetime64[s]'), ('v', 'float32')])
+SMOOTHING_WINDOW = 10  # Samples
+GAP_FACTOR = 3  # A step this many times the usual sample interval is a gap in the data, not a slow sample
 
 
 @dataclass
@@ -43,6 +41,11 @@ class Station:
     lon: float
 
 
+def _datagetter_url(params: dict) -> str:
+    param_str = '&'.join(f'{k}={v}' for k, v in params.items())
+    return f'{WATER_TEMPS_URL_BASE}?{param_str}'
+
+
 def get_water_temps(
         station_id: Optional[str] = None, hours: int = 36, units='english', path=None
 ) -> (Station, pd.Series):
@@ -57,62 +60,220 @@ def get_water_temps(
         'units': units,
         'time_zone': 'gmt',  # Setting UTC timezone below
     }
-    param_str = '&'.join(f'{k}={v}' for k, v in params.items())
-    url = f'{WATER_TEMPS_URL_BASE}?{param_str}'
-    if path is None:
-        now = pendulum.now().format('YYYYMMDD_HHmmss')
-        filename = f'water_temps_{station_id}_{now}_{hours}h.json'
-        path = os.path.join(CACHE_DIR, filename)
-        _cleanup_paths.append(path)
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    urlretrieve(url, path)
-    with open(path) as f:
-        data_dct = json.load(f)
+    url = _datagetter_url(params)
+    body = cached_read(url, source='water_temps')
+    if path is not None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(body)
+    return parse_water_temps_json(body)
+
 
+def get_water_temps_range(
+        station_id: str, begin: pd.Timestamp, end: pd.Timestamp, units='english'
+) -> (Optional[Station], pd.Series):
+    # Every (6-minute) sample between two UTC times; NOAA caps these requests at 31 days
+    params = {
+        'product': 'water_temperature',
+        'station': station_id,
+        'begin_date': begin.strftime(RANGE_DATE_FMT),
+        'end_date': end.strftime(RANGE_DATE_FMT),
+        'format': 'json',
+        'units': units,
+        'time_zone': 'gmt',
+    }
+    body = cached_read(_datagetter_url(params), source='water_temps')
+    if 'error' in json.loads(body):
+        # e.g. "No data was found" for a window with no new samples yet
+        return None, pd.Series(dtype='float64', index=pd.DatetimeIndex([], tz='UTC', name='t'), name='v')
+    return parse_water_temps_json(body)
+
+
+@timed('parse')
+def parse_water_temps_json(body: bytes) -> (Station, pd.Series):
+    data_dct = json.loads(body)
     station_info = Station(**data_dct['metadata'])
-    water_temps = pd.DataFrame(data_dct['data']).set_index('t')['v']
-    water_temps.index = pd.DatetimeIndex(pd.to_datetime(water_temps.index, utc=True))
+    data = pd.DataFrame.from_records(data_dct['data'], columns=['t', 'v'])
+    index = pd.DatetimeIndex(pd.to_datetime(data['t'], format=DATA_TIME_FMT, utc=True), name='t')
+    water_temps = pd.Series(pd.to_numeric(data['v'], errors='coerce').to_numpy(dtype='float64'), index=index, name='v')
     return station_info, water_temps
 
 
-def plot_temps_file(water_temps: pd.Series, station: Station, path=None, keep=False):
+def _as_utc(t) -> pd.Timestamp:
+    t = pd.Timestamp(t)
+    return t.tz_localize('UTC') if t.tzinfo is None else t.tz_convert('UTC')
+
+
+def water_temps_archive(station_id: str, units='english') -> MemmapArchive:
+    return MemmapArchive(os.path.join(ARCHIVE_DIR, f'water_temps_{station_id}_{units}.bin'), ARCHIVE_DTYPE)
+
+
+def _station_info_path(station_id: str) -> str:
+    return os.path.join(ARCHIVE_DIR, f'water_temps_{station_id}.json')
+
+
+def _save_station_info(station: Station):
+    path = _station_info_path(station.id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(asdict(station), f)
+    os.replace(tmp_path, path)
+
+
+def archived_station_info(station_id: str, units='english') -> Station:
+    # Saved alongside the archive, but an archive that was already up to date (or only ever got "No data" windows)
+    # may not have it yet; then it comes from the metadata of the latest hour of observations
+    try:
+        with open(_station_info_path(station_id)) as f:
+            return Station(**json.load(f))
+    except FileNotFoundError:
+        station, _ = get_water_temps(station_id=station_id, hours=1, units=units)
+        _save_station_info(station)
+        return station
+
+
+def update_water_temps_archive(
+        station_id: Optional[str] = None, units='english', backfill_days=DEFAULT_BACKFILL_DAYS,
+        now: Optional[pd.Timestamp] = None,
+) -> int:
+    # Fetch only what's newer than the last stored sample (or `backfill_days` for a new archive) and append it
+    if station_id is None:
+        station_id = THE_BATTERY_STATION_ID
+    archive = water_temps_archive(station_id, units=units)
+    end = pd.Timestamp.now(tz='UTC') if now is None else _as_utc(now)
+    last = archive.last_time
+    if last is None:
+        start = end - pd.Timedelta(days=backfill_days)
+    else:
+        start = pd.Timestamp(last).tz_localize('UTC') + pd.Timedelta(minutes=1)
+    appended = 0
+    chunk = pd.Timedelta(days=MAX_DAYS_PER_REQUEST)
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + chunk, end)
+        station, water_temps = get_water_temps_range(station_id, chunk_start, chunk_end, units=units)
+        water_temps = water_temps.dropna()
+        if station is not None and not os.path.exists(_station_info_path(station_id)):
+            _save_station_info(station)
+        records = np.empty(len(water_temps), dtype=ARCHIVE_DTYPE)
+        records['t'] = water_temps.index.tz_convert(None).to_numpy(dtype='datetime64[s]')
+        records['v'] = water_temps.to_numpy(dtype='float32')
+        appended += archive.append(records)
+        chunk_start = chunk_end
+    return appended
+
+
+def get_archived_water_temps(
+        station_id: Optional[str] = None, start=None, end=None, units='english'
+) -> pd.Series:
+    if station_id is None:
+        station_id = THE_BATTERY_STATION_ID
+
+    def to_utc64(t):
+        return None if t is None else _as_utc(t).tz_localize(None).to_datetime64()
+
+    records = water_temps_archive(station_id, units=units).read(to_utc64(start), to_utc64(end))
+    index = pd.DatetimeIndex(records['t'], name='t').tz_localize('UTC')
+    return pd.Series(np.asarray(records['v'], dtype='float64'), index=index, name='v')
+
+
+def year_over_year(
+        station_id: Optional[str] = None, at=None, window_days: int = 7, units='english'
+) -> (float, float):
+    # Mean temperature over the `window_days` up to `at`, this year and the same window a year earlier
+    at = pd.Timestamp.now(tz='UTC') if at is None else _as_utc(at)
+    window = pd.Timedelta(days=window_days)
+    this_year = get_archived_water_temps(station_id, at - window, at, units=units)
+    a_year_ago = at - pd.DateOffset(years=1)
+    last_year = get_archived_water_temps(station_id, a_year_ago - window, a_year_ago, units=units)
+    return this_year.mean(), last_year.mean()
+
+
+def _mark_gaps(water_temps: pd.Series) -> (pd.Series, np.ndarray):
+    # A NaN sample in each gap (the archive only stores what was observed), and where they went
+    index = water_temps.index
+    no_gaps = np.zeros(len(index), dtype=bool)
+    if len(index) < 3:
+        return water_temps, no_gaps
+    steps = index[1:] - index[:-1]
+    gaps = np.flatnonzero(steps > GAP_FACTOR * steps.median())
+    if len(gaps) == 0:
+        return water_temps, no_gaps
+    midpoints = index[gaps] + steps[gaps] / 2
+    marked = pd.concat([water_temps, pd.Series(np.nan, index=midpoints)]).sort_index(kind='stable')
+    return marked, marked.index.isin(midpoints) & marked.isna().to_numpy()
+
+
+def _draw_water_temps(ax, water_temps: pd.Series, title: str):
+    # Smoothed at full resolution, then cut down to about two points per pixel column, so weeks of 6-minute samples
+    # draw as fast (and compress as small) as a day and a half of hourly ones. Gaps stay NaN through both steps, so
+    # the line breaks there instead of drawing straight across.
+    water_temps, gap = _mark_gaps(water_temps)
+    smoothed = moving_average(water_temps.to_numpy(dtype='float64'), SMOOTHING_WINDOW)
+    # No window averages across a gap: the samples next to one only take their own side
+    smoothed[moving_average(gap.astype('float64'), SMOOTHING_WINDOW) > 0] = np.nan
+    keep = minmax_downsample(smoothed, max(int(ax.get_window_extent().width), 1))
+    ax.plot(water_temps.index[keep], smoothed[keep])
+    span = water_temps.index[-1] - water_temps.index[0] if len(water_temps) else pd.Timedelta(0)
+    fmt = DateTimeFormats.h_m_s if span <= pd.Timedelta(days=2) else DateTimeFormats.y_m_d
+    ax.xaxis.set_major_formatter(DateFormatter(fmt))
+    ax.tick_params(axis='x', labelrotation=45)
+    ax.set_ylabel('Water Temp. (F)')
+    ax.set_title(title)
+
+
+def plot_temps_file(water_temps: pd.Series, station: Station, path=None, dpi: int = DEFAULT_DPI) -> str | bytes:
+    # Writes to `path` if given, otherwise returns the PNG bytes
     start_dt = water_temps.index[0]
     end_dt = water_temps.index[-1]
     title_dt_fmt = '%H:%M:%S %m/%d/%Y'
     title = f'{start_dt.strftime(title_dt_fmt)} - {end_dt.strftime(title_dt_fmt)} at {station.name}'
-    ylabel = 'Water Temp. (F)'
-    xtick_dt_fmt = DateTimeFormats.h_m_s
-
-    if path is None:
-        now = pendulum.now().format('YYYYMMDD_HHmmss')
-        filename = f'water_temps_{station.id}_{now}.png'
-        path = os.path.join(CACHE_DIR, filename)
-        if not keep:
-            _cleanup_paths.append(path)
-
-    sns.set_theme()
-    plt.figure(figsize=(10, 4))
-    plt.plot(water_temps.rolling(10, center=True, win_type='boxcar').mean())
-    plt.gca().xaxis.set_major_formatter(DateFormatter(xtick_dt_fmt))
-    plt.xticks(rotation=45)
-    plt.ylabel(ylabel)
-    plt.title(title)
-    plt.savefig(path, bbox_inches='tight', pad_inches=0.25)
-
-    return path
-
-
-def post_water_temps(channel: str, station: Optional[str] = None) -> None:
-    station, water_temps = get_water_temps(station_id=station)
-    plot_img_path = plot_temps_file(water_temps, station)
+    return render_figure(partial(_draw_water_temps, water_temps=water_temps, title=title), path=path, dpi=dpi)
+
+
+def plot_temps_files(
+        stations_temps: Sequence[Tuple[Station, pd.Series]], processes: Optional[int] = None
+) -> List[bytes]:
+    # PNG bytes for each (station, temps) pair, rendered in parallel processes
+    return render_many(plot_temps_file, [(water_temps, station) for station, water_temps in stations_temps],
+                       processes=processes)
+
+
+def render_water_temps(
+        station: Optional[str] = None, archive_days: Optional[int] = None,
+        image_output: ImageOutput = DEFAULT_IMAGE_OUTPUT,
+) -> List[SlackPost]:
+    if archive_days is None:
+        station, water_temps = get_water_temps(station_id=station)
+        span = 'the last 36 hours'
+    else:
+        station_id = THE_BATTERY_STATION_ID if station is None else station
+        update_water_temps_archive(station_id)
+        start = pd.Timestamp.now(tz='UTC') - pd.Timedelta(days=archive_days)
+        water_temps = get_archived_water_temps(station_id, start=start)
+        station = archived_station_info(station_id)
+        span = f'the last {archive_days} days'
     observations_url = OBSERVATIONS_URL_TEMPLATE.format(id=station.id)
-    post_txt = f"<{observations_url}|NOAA water temperature observations at {station.name} for the last 36 hours>\n"
-    post_file(plot_img_path, channel, comment=post_txt)
+    post_txt = f"<{observations_url}|NOAA water temperature observations at {station.name} for {span}>\n"
+    dedup_key = f'water_temps:{station.id}:{span}'
+    try:
+        image = compact_image(plot_temps_file(water_temps, station, dpi=image_output.dpi), image_output,
+                              name='water_temps')
+    except ImageBudgetError:
+        # The link to the observations still goes out without the plot (counted as image_over_budget)
+        return [SlackPost(text=post_txt, dedup_key=dedup_key)]
+    filename = f'water_temps_{station.id}_{pendulum.now().format("YYYYMMDD_HHmmss")}{image.extension}'
+    return [SlackPost(text=post_txt, file=image.data, filename=filename, dedup_key=dedup_key)]
 
 
-def _cleanup():
-    for path in _cleanup_paths:
-        os.remove(path)
+def post_water_temps(
+        channel: str, station: Optional[str] = None, archive_days: Optional[int] = None,
+        dedup: bool | PostDedupStore = True, image_output: ImageOutput = DEFAULT_IMAGE_OUTPUT,
+) -> None:
+    dedup = resolve_dedup(dedup)
+    for post in render_water_temps(station=station, archive_days=archive_days, image_output=image_output):
+        send_post(post, channel, dedup=dedup)
 
 
 """----------------------------------------------------------------------------
@@ -124,13 +285,18 @@ def parse_args():
     parser = ArgumentParser()
     parser.add_argument('--station', type=str, default=THE_BATTERY_STATION_ID)
     parser.add_argument('--channel', type=str, default=NykpSlackChannels.test_python_api)
+    parser.add_argument('--archive-days', type=int, default=None,
+                        help='Update the local archive and plot this many days from it')
+    parser.add_argument('--dedup', type=str2bool, default=True, help='Skip posts unchanged since the last run')
+    parser.add_argument('--webp', type=str2bool, default=None, help='Upload images as WebP instead of PNG')
+    parser.add_argument('--max-image-kb', type=float, default=None, help='Byte budget for each uploaded image')
     return parser
 
 
 def main(args):
-    station, water_temps = get_water_temps(station_id=args.station)
-    post_water_temps(args.channel, station, water_temps)
-    _cleanup()
+    image_output = DEFAULT_IMAGE_OUTPUT.with_overrides(webp=args.webp, max_kb=args.max_image_kb)
+    post_water_temps(args.channel, station=args.station, archive_days=args.archive_days, dedup=args.dedup,
+                     image_output=image_output)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The scripts import each other as top-level modules, the way they're run from nykp_conditions/
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'nykp_conditions')))
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
@@ -0,0 +1,30 @@
+import os
+
+from conftest import FIXTURES_DIR
+from currents_harmonics import compare_to_noaa, load_harmonics, predict_currents_table
+from noaa_currents import CurrentsPredictions, parse_currents_csv
+
+# Not NOAA parity: the constants are illustrative, and the reference is the same curve summed one timestamp at a time
+# with events found by scanning it, so this checks the vectorized synthesis and event detection, not the model
+STATION_ID = 'NYH1928'
+DATE = '2024-06-14'
+DAYS = 3
+MAX_TIME_DIFF_MINUTES = 10
+MAX_KNOTS_DIFF = 0.1
+
+
+def _brute_force_reference() -> CurrentsPredictions:
+    with open(os.path.join(FIXTURES_DIR, f'{STATION_ID}_{DATE}_brute_force.csv'), 'rb') as f:
+        return CurrentsPredictions(parse_currents_csv(f.read()), '')
+
+
+def test_events_match_brute_force_reference():
+    harmonics = load_harmonics(STATION_ID, path=os.path.join(FIXTURES_DIR, f'{STATION_ID}_harcon_synthetic.json'))
+    computed = predict_currents_table(STATION_ID, date=DATE, days=DAYS, harmonics=harmonics)
+    matched = compare_to_noaa(computed, _brute_force_reference())
+
+    assert len(matched) > 0
+    assert matched['time_diff_minutes'].notna().all()
+    assert matched['time_diff_minutes'].abs().max() <= MAX_TIME_DIFF_MINUTES
+    speeds = matched[matched['stage'] != 'slack']
+    assert speeds['knots_diff'].abs().max() <= MAX_KNOTS_DIFF